@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmarks the render pipeline without hardware: setPixel, show,
+setBarLevel, setAllColor and MQTT payload handling of strips from 1 to
+5000 LEDs and ledcfg tables of several sizes, writing into a fake SPI
+device. Prints the cost per call and optionally saves all results as JSON
+to compare runs before and after a change.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+from copy import deepcopy
+from argparse import ArgumentParser
+
+import numpy as np
+
+from sensorvis import Strip, DEFAULTS
+from sensorvis.dispatch import Dispatcher
+
+COLORS = {"green": 0x00FF00, "yellow": 0xFFAA00, "orange": 0xFF3300, "red": 0xFF0000, "blue": 0x0000FF}
+MAX_VALUE = 5000
+
+class FakeSpi(object):
+  """takes the frames like spidev would and only counts them"""
+
+  def __init__(self):
+    self.frames = 0
+    self.bytes = 0
+
+  def write(self, buf):
+    self.frames += 1
+    self.bytes += len(buf)
+
+  def close(self):
+    pass
+
+def benchCfg(leds, steps, gamma, dither):
+  """a strip of leds LEDs with a ledcfg of steps steps, the bar growing to full length"""
+  names = list(COLORS)
+  ledcfg = []
+  for step in range(steps):
+    nbar = max(1, (leds - 1) * (step + 1) // steps)
+    ledcfg.append({'from': MAX_VALUE * step // steps, 'leds': [{'c': names[i * len(names) // nbar]} for i in range(nbar)]})
+  cfg = deepcopy(DEFAULTS) # the daemon's defaults with the bench settings on top
+  cfg.update({
+    "busfreq": 8000000, "leds": leds, "fixed": 1, "maxvalue": MAX_VALUE,
+    "gamma": gamma, "dither": dither,
+    "thresholds": [[0, "green"], [800, "yellow"], [1500, "orange"], [2500, "red"]],
+    "thresholds_single": [], "ledcfg": ledcfg, "colors": COLORS,
+    "target": {"tags": {"sensor": "SCD30"}, "measurement": "gas", "value": "CO2_ppm"},
+  })
+  return cfg
+
+def timed(fn, calls):
+  """microseconds per call of fn(i) for i in 0 .. calls-1"""
+  t0 = time.perf_counter()
+  for i in range(calls):
+    fn(i)
+  return (time.perf_counter() - t0) * 1e6 / calls
+
+def benchStrip(leds, steps, calls, gamma, dither):
+  t0 = time.perf_counter()
+  strip = Strip('bench', benchCfg(leds, steps, gamma, dither), 'localhost')
+  compile_ms = (time.perf_counter() - t0) * 1000
+  spi = FakeSpi()
+  strip.open(writer=False, out=spi)
+  red = strip.bar.palette_rgb['red']
+  blue = strip.bar.palette_rgb['blue']
+  results = {'compile_ms': compile_ms}
+
+  def setPixel(i):
+    strip.setPixel(i % leds, *(red if i // leds % 2 else blue))
+  results['setPixel'] = timed(setPixel, calls)
+
+  def show(i): # one changed LED, handed over and sent
+    setPixel(i)
+    strip.show()
+    strip.writeReady()
+  results['show'] = timed(show, calls) - results['setPixel']
+
+  values = np.linspace(0, MAX_VALUE, 97).tolist() # crosses the steps in both directions
+  def setBarLevel(i):
+    strip.setBarLevel(values[i % len(values)] if i // len(values) % 2 else values[-1 - i % len(values)])
+    strip.writeReady()
+  results['setBarLevel'] = timed(setBarLevel, calls)
+
+  def setAllColor(i):
+    strip.setAllColor('red' if i % 2 else 'blue')
+    strip.writeReady()
+  results['setAllColor'] = timed(setAllColor, calls)
+
+  dispatcher = Dispatcher([strip])
+  payloads = [json.dumps({'tags': {}, 'values': {'CO2_ppm': v}}).encode() for v in values]
+  def onMessage(i): # decode and post, rendered later by the strip thread
+    dispatcher.dispatch(strip.topic, payloads[i % len(payloads)])
+    strip.takeValue(0)
+  results['on_message'] = timed(onMessage, calls)
+
+  results['frames'] = spi.frames
+  results['bytes_per_frame'] = spi.bytes / max(spi.frames, 1)
+  strip.close()
+  return results
+
+parser = ArgumentParser(description='render pipeline benchmark against a fake SPI device')
+parser.add_argument("-l", "--leds", type=int, nargs='+', default=[1, 8, 144, 1000, 5000],
+                            help="LED counts", metavar="n")
+parser.add_argument("-t", "--steps", type=int, nargs='+', default=[8, 64, 512],
+                            help="ledcfg sizes (steps)", metavar="n")
+parser.add_argument("-n", "--calls", type=int, default=500, help="calls per measurement {500}", metavar="n")
+parser.add_argument("-g", "--gamma", type=float, default=1, help="gamma correction {1}", metavar="g")
+parser.add_argument("-d", "--dither", action='store_true', help="temporal dithering")
+parser.add_argument("-j", "--json", type=str, help="save results to this JSON file", metavar="file")
+args = parser.parse_args()
+
+OPS = ['setPixel', 'show', 'setBarLevel', 'setAllColor', 'on_message']
+rows = []
+for leds in args.leds:
+  for steps in args.steps:
+    result = benchStrip(leds, steps, args.calls, args.gamma, args.dither)
+    result.update({'leds': leds, 'steps': steps})
+    rows.append(result)
+
+print("microseconds per call (show: per frame incl. transfer to the fake SPI)")
+print("%6s %6s %11s" % ("leds", "steps", "compile ms") + "".join(" %12s" % op for op in OPS))
+for row in rows:
+  print("%6d %6d %11.1f" % (row['leds'], row['steps'], row['compile_ms']) + "".join(" %12.1f" % row[op] for op in OPS))
+
+if args.json:
+  with open(args.json, 'w') as f:
+    json.dump({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': os.uname()[1],
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'calls': args.calls, 'gamma': args.gamma, 'dither': args.dither,
+        'results': rows,
+      }, f, indent=2)
+  print("results saved to", args.json)
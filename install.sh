@@ -27,12 +27,13 @@ if [ ! "$1" ]; then
   if [ $((now - last_update)) -gt 86400 ]; then
     aptitude update
   fi
-  aptitude install -y python3-spidev python3-paho-mqtt mosquitto python3-yaml python3-sdnotify
+  aptitude install -y python3-spidev python3-paho-mqtt mosquitto python3-yaml python3-sdnotify python3-numpy
 
   mkdir -p $targetdir 
 fi
 
 exe1=apa102.py
+lib1=sensorvis
 serv1=apa102.service
 
 conffolder="/etc/lcars/"
@@ -51,6 +52,7 @@ cd ..
 
 
 rsync -raxc --info=name $exe1 $targetdir
+rsync -raxc --info=name --exclude=__pycache__ $lib1 $targetdir
 
 rsync -raxc --info=name $serv1 /etc/systemd/system/
 
@@ -0,0 +1,34 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Displays sensor data (e.g. CO2 levels) on APA102 RGB LED-Strips
+
+Importing the package does not touch any hardware or the network and does
+not load yaml or paho: Daemon(cfg).run() is the daemon of apa102.py,
+Strip(name, cfg, hostname).open(out=SimOutput(leds)) one strip on its own.
+"""
+
+from .strip import Strip
+from .config import DEFAULTS, argParser, buildConfig, stripConfigs
+from .cache import ConfigCache
+from .output import SpiOutput, SimOutput
+from .mqtt import MqttInput
+from .stream import StreamInput
+from .shm import SharedFrame, ShmInput
+from .daemon import Daemon
@@ -0,0 +1,261 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""asyncio runtime: MQTT, stream and framebuffer input, timeouts, error wheel, watchdog and SPI output on one event loop"""
+
+import time
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .strip import eprint
+from .scheduler import FrameScheduler
+from .trace import tracer
+
+class AsyncRuntime(object):
+  """
+  Replaces the MQTT loop thread and the strip threads: paho's socket is
+  served by the event loop, a timeout is a timer at the exact deadline and
+  SPI transfers run in one single-thread executor per strip, so the loop
+  never blocks on a bus and the strips stay independent.
+  """
+
+  __slots__ = ('client', 'brokerhost', 'topics', 'strips', 'notify', 'interval', 'signals', 'tick', 'stream', 'shm', 'debug',
+    'loop', 'running', 'ready', 'misc', 'tasks', 'wakeups', 'timers', 'executors')
+
+  def __init__(self, client, brokerhost, topics, strips, notify, interval, signals=None, tick=None, stream=None, shm=None, debug=False):
+    """
+    signals: {signum: handler} called in an executor thread, tick: called
+    with every watchdog round, stream: a StreamInput read on the loop,
+    shm: a ShmInput polled on the loop
+    """
+    self.client = client
+    self.brokerhost = brokerhost
+    self.topics = topics
+    self.strips = strips
+    self.notify = notify
+    self.interval = interval
+    self.signals = signals or {}
+    self.tick = tick
+    self.stream = stream
+    self.shm = shm
+    self.debug = debug
+    self.loop = None
+    self.running = False
+    self.ready = False
+    self.misc = None
+    self.tasks = []
+    self.wakeups = {}
+    self.timers = {} # strip -> pending timeout
+    self.executors = {}
+
+  # --- paho socket on the event loop ---
+
+  def onSocketOpen(self, client, userdata, sock):
+    self.loop.add_reader(sock, client.loop_read)
+    self.misc = self.loop.create_task(self.miscLoop())
+
+  def onSocketClose(self, client, userdata, sock):
+    self.loop.remove_reader(sock)
+    if self.misc:
+      self.misc.cancel()
+      self.misc = None
+
+  def onSocketRegisterWrite(self, client, userdata, sock):
+    self.loop.add_writer(sock, client.loop_write)
+
+  def onSocketUnregisterWrite(self, client, userdata, sock):
+    self.loop.remove_writer(sock)
+
+  async def miscLoop(self):
+    """keepalive pings and retries, paho wants this about once a second"""
+    while self.client.loop_misc() == 0: # MQTT_ERR_SUCCESS
+      await asyncio.sleep(1)
+
+  def onConnect(self, client, userdata, flags, rc):
+    if rc != 0:
+      eprint('mqtt: failure on connect to broker "'+ self.brokerhost+ '", result code:', str(rc))
+      self.loop.create_task(self.connect(reconnect=True))
+      return
+    print("mqtt: Connected to broker", self.brokerhost, "with result code", str(rc))
+    for topic in self.topics:
+      client.subscribe(topic)
+      print("mqtt: subscribing to", topic)
+
+  def onDisconnect(self, client, userdata, rc):
+    if rc != 0 and self.running:
+      print("mqtt: Unexpected disconnection.")
+      self.loop.create_task(self.connect(reconnect=True))
+
+  async def connect(self, reconnect=False):
+    while self.running:
+      try:
+        print("mqtt: Connecting to", self.brokerhost)
+        if reconnect:
+          self.client.reconnect()
+        else:
+          self.client.connect(self.brokerhost,1883,60)
+        print('mqtt: connect successful')
+        return
+      except Exception as e:
+        eprint('mqtt: Exception in connect to "' + self.brokerhost + '", E:', e, '\nnext attempt in 3s')
+        await asyncio.sleep(3)
+
+  # --- strips ---
+
+  def onPost(self, strip):
+    """a new value for strip: restart its timeout and wake its render task"""
+    self.cancelTimer(strip)
+    strip.clearTimeout()
+    self.timers[strip] = self.loop.call_later(strip.timeout_s, self.timedOut, strip)
+    self.wakeups[strip].set()
+
+  def cancelTimer(self, strip):
+    timer = self.timers.pop(strip, None)
+    if timer:
+      timer.cancel()
+
+  def onConfig(self, strip):
+    """a reloaded config was swapped in: the pending timeout moves to the new timeout_s"""
+    self.cancelTimer(strip)
+    now = self.loop.time()
+    delay = strip.last_update + strip.timeout_s - now
+    if delay > 0:
+      strip.clearTimeout()
+      self.timers[strip] = self.loop.call_later(delay, self.timedOut, strip)
+    else: # already over, the rest of this frame shows the error wheel
+      strip.setTimeout(now)
+
+  def timedOut(self, strip):
+    self.timers.pop(strip, None)
+    now = self.loop.time()
+    strip.setTimeout(now)
+    strip.renderFrame(now)
+    self.wakeups[strip].set()
+
+  async def frames(self, strip):
+    """error color wheel on the strip's frame schedule, deadlines on the loop's monotonic clock"""
+    strip.scheduler = scheduler = FrameScheduler(strip.fps, clock=self.loop.time)
+    while self.running:
+      await asyncio.sleep(max(scheduler.remaining(), 0))
+      tracer.profilePoint()
+      now = self.loop.time()
+      tracer.add('wake', strip.name, scheduler.next_frame, now)
+      strip.renderFrame(now)
+      tracer.add('tick', strip.name, scheduler.next_frame, self.loop.time())
+      if strip.dirty_leds or strip.ready_dirty:
+        self.wakeups[strip].set()
+      if not scheduler.tick():
+        self.debug and print(strip.name, "frame overrun,", scheduler.stats())
+
+  async def runStrip(self, strip):
+    """renders the newest value and sends the newest frame, one transfer at a time"""
+    wake = self.wakeups[strip]
+    executor = self.executors[strip]
+    while self.running:
+      await wake.wait()
+      wake.clear()
+      value = strip.takeValue(0)
+      if value is not None:
+        try:
+          strip.render(value)
+          strip.values_rendered += 1
+        except Exception as e:
+          eprint(strip.name, e)
+      # values arriving during the transfer coalesce in the strip's slot
+      while await self.loop.run_in_executor(executor, strip.writeReady):
+        self.checkReady()
+
+  async def pollShm(self):
+    while self.running:
+      self.shm.poll()
+      await asyncio.sleep(self.shm.period)
+
+  def checkReady(self):
+    """sends READY=1 once every strip has its first frame out"""
+    if not self.ready and all(strip.first_frame.is_set() for strip in self.strips):
+      self.ready = True
+      self.notify("READY=1")
+      print("ready, first frames out")
+
+  async def watchdog(self):
+    while self.running:
+      t0 = time.perf_counter()
+      tracer.profilePoint()
+      self.checkReady()
+      self.tick and self.tick()
+      if all(not task.done() for task in self.tasks):
+        self.notify("WATCHDOG=1")
+      else:
+        eprint("strip task died, not feeding watchdog")
+      tracer.add('main', None, t0, time.perf_counter())
+      await asyncio.sleep(self.interval)
+
+  # --- main ---
+
+  def stop(self):
+    print("exit gracefully...")
+    self.running = False
+    for task in self.tasks:
+      task.cancel()
+
+  async def main(self):
+    self.loop = asyncio.get_event_loop()
+    self.running = True
+    client = self.client
+    client.on_connect = self.onConnect
+    client.on_disconnect = self.onDisconnect
+    client.on_socket_open = self.onSocketOpen
+    client.on_socket_close = self.onSocketClose
+    client.on_socket_register_write = self.onSocketRegisterWrite
+    client.on_socket_unregister_write = self.onSocketUnregisterWrite
+    for sig in (signal.SIGINT, signal.SIGTERM):
+      self.loop.add_signal_handler(sig, self.stop)
+    for (sig, handler) in self.signals.items():
+      self.loop.add_signal_handler(sig, self.loop.run_in_executor, None, handler)
+
+    for strip in self.strips:
+      self.wakeups[strip] = asyncio.Event()
+      self.executors[strip] = ThreadPoolExecutor(max_workers=1)
+      strip.on_post = self.onPost
+      strip.on_config = self.onConfig
+      self.timers[strip] = self.loop.call_later(strip.timeout_s, self.timedOut, strip)
+      self.tasks.append(self.loop.create_task(self.runStrip(strip)))
+      self.tasks.append(self.loop.create_task(self.frames(strip)))
+    self.tasks.append(self.loop.create_task(self.watchdog()))
+    self.shm and self.tasks.append(self.loop.create_task(self.pollShm()))
+    socks = self.stream.socks if self.stream else []
+    for sock in socks:
+      sock.setblocking(False)
+      self.loop.add_reader(sock, self.stream.receive, sock)
+
+    await self.connect()
+    try:
+      await asyncio.gather(*self.tasks)
+    except asyncio.CancelledError:
+      pass
+    for sock in socks:
+      self.loop.remove_reader(sock)
+    for strip in self.strips:
+      self.cancelTimer(strip)
+      self.executors[strip].shutdown()
+    client.disconnect()
+    print("async runtime finished")
+
+  def run(self):
+    asyncio.run(self.main())
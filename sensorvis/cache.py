@@ -0,0 +1,114 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Cache of the parsed config file and the compiled strips, to skip YAML and compiling at startup"""
+
+import os
+import json
+import pickle
+import hashlib
+
+from .strip import eprint, STATE_KEYS
+
+CACHE_VERSION = 3 # bump when the render state changes
+
+def codeFingerprint():
+  """hash of the sources of this package: a cache written by other code is never used"""
+  directory = os.path.dirname(os.path.abspath(__file__))
+  digest = hashlib.sha1()
+  for name in sorted(os.listdir(directory)):
+    if name.endswith('.py'):
+      with open(os.path.join(directory, name), 'rb') as f:
+        digest.update(name.encode() + b'\0' + f.read())
+  return digest.hexdigest()
+
+class ConfigCache(object):
+  """
+  One pickle file with the settings of the config file, valid while path,
+  mtime and content hash of the file and the code are unchanged, and the compiled
+  render state of each strip, keyed by a hash of the strip settings it
+  is compiled from.
+  A stale or unreadable cache is just rebuilt.
+  """
+
+  __slots__ = ('cachefile', 'path', 'key', 'record', 'used', 'dirty')
+
+  def __init__(self, cachefile, path):
+    self.cachefile = cachefile
+    self.path = os.path.abspath(path)
+    self.key = None
+    self.record = None
+    self.used = {} # strip states needed by this run, the only ones saved
+    self.dirty = False
+    try:
+      with open(path, 'rb') as f:
+        content = f.read()
+      self.key = (CACHE_VERSION, codeFingerprint(), self.path, os.stat(path).st_mtime_ns, hashlib.sha1(content).hexdigest())
+    except OSError:
+      return
+    try:
+      with open(cachefile, 'rb') as f:
+        record = pickle.load(f)
+      if record['key'] == self.key:
+        self.record = record
+    except Exception: # missing, from an older version or broken: rebuilt
+      pass
+
+  def fileConfig(self):
+    """settings of the config file if cached for its current content, else None"""
+    return self.record['filecfg'] if self.record else None
+
+  def storeFileConfig(self, filecfg):
+    if self.key is None:
+      return
+    self.record = {'key': self.key, 'filecfg': filecfg, 'strips': {}}
+    self.dirty = True
+
+  def stripKey(self, name, cfg, debug):
+    """hash of what the render state is compiled from: name, debug and the STATE_KEYS of cfg"""
+    settings = dict((key, cfg.get(key)) for key in STATE_KEYS)
+    return hashlib.sha1(json.dumps([name, settings, debug], sort_keys=True, default=repr).encode()).hexdigest()
+
+  def strip(self, key):
+    """compiled render state for a strip config key, None if not cached"""
+    state = self.record['strips'].get(key) if self.record else None
+    if state:
+      self.used[key] = state
+    return state
+
+  def storeStrip(self, key, state):
+    state = dict(state)
+    state.pop('cfg', None) # the strip has its own
+    self.used[key] = state
+    self.dirty = True
+
+  def save(self):
+    """writes the cache if anything changed, atomically by rename"""
+    if not self.dirty or self.record is None:
+      return
+    self.record['strips'] = self.used
+    tmp = self.cachefile + '.tmp'
+    try:
+      os.makedirs(os.path.dirname(self.cachefile) or '.', exist_ok=True)
+      with open(tmp, 'wb') as f:
+        pickle.dump(self.record, f, pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp, self.cachefile)
+      self.dirty = False
+      print("config cache saved to", self.cachefile)
+    except OSError as e:
+      eprint('config cache not saved:', e)
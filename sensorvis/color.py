@@ -0,0 +1,104 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Lookup tables for the pixel encoder: brightness header and gamma correction"""
+
+from math import ceil
+
+import numpy as np
+
+MAX_BRIGHTNESS = 31 # Safeguard: Max. brightness that can be selected.
+LED_START = 0b11100000 # Three "1" bits, followed by 5 brightness bits
+
+def brightnessLut(brightness, max_brightness=MAX_BRIGHTNESS):
+  """
+  header byte for every percentage 0..100 of the strip brightness (itself
+  a percentage of max_brightness, 0..31): percent -> LED_START | 5 bit brightness
+  """
+  brightness = min(max(brightness, 0), 100)
+  max_brightness = min(max(int(max_brightness), 0), MAX_BRIGHTNESS)
+  return [LED_START | int(ceil(percent * brightness * max_brightness / 10000.0)) for percent in range(101)]
+
+def gammaTables(gamma, top=255):
+  """
+  gamma: one float for all channels or [red, green, blue], returns three
+  256 entry tables from 0 to top (255, or e.g. 255 * 256 for 8.8 fixed point)
+  """
+  if isinstance(gamma, (int, float)):
+    gamma = [gamma] * 3
+  if len(gamma) != 3:
+    raise ValueError('gamma needs one value or three for red, green, blue, got ' + str(gamma))
+  return [[int(round(top * (i / 255.0) ** g)) for i in range(256)] for g in gamma]
+
+class GammaLut(object):
+  """
+  Per channel gamma tables applied to a whole encoded frame at once: one
+  NumPy fancy-index lookup of each (channel, value) pair. The header byte
+  maps to itself.
+  """
+
+  __slots__ = ('lut', 'channels')
+
+  def __init__(self, gamma):
+    (red, green, blue) = gammaTables(gamma)
+    # pixel layout: header, blue, green, red
+    self.lut = np.array([range(256), blue, green, red], dtype=np.uint8)
+    self.channels = np.arange(4)
+
+  def apply(self, src, dst):
+    """src, dst: encoded pixel buffers (4 bytes per LED) of the same size"""
+    pixels = np.frombuffer(src, dtype=np.uint8).reshape(-1, 4)
+    np.frombuffer(dst, dtype=np.uint8).reshape(-1, 4)[:] = self.lut[self.channels, pixels]
+
+class Dither(object):
+  """
+  Temporal dithering of a whole encoded frame with NumPy, gamma included.
+  Works in 8.8 fixed point: every pixel gets the lowest global brightness
+  that still fits its brightest channel, which leaves more RGB steps for
+  dim pixels, and the part below one RGB step is carried over to the next
+  frame. residual tells whether the frame has to be refreshed to show the
+  sub-step values, a frame without fractions needs no refresh.
+  """
+
+  __slots__ = ('lut', 'channels', 'err', 'residual')
+
+  def __init__(self, gamma, nleds):
+    (red, green, blue) = gammaTables(gamma, 255 * 256)
+    # rows for the pixel bytes blue, green, red
+    self.lut = np.array([blue, green, red], dtype=np.int32)
+    self.channels = np.arange(3)
+    self.err = np.zeros((nleds, 3), dtype=np.int32)
+    self.residual = False
+
+  def apply(self, src, dst):
+    """src, dst: encoded pixel buffers (4 bytes per LED) of the same size"""
+    pixels = np.frombuffer(src, dtype=np.uint8).reshape(-1, 4)
+    out = np.frombuffer(dst, dtype=np.uint8).reshape(-1, 4)
+    # light per channel in 1/256 steps at global brightness 1
+    light = self.lut[self.channels, pixels[:, 1:]]
+    light *= (pixels[:, 0] & 0x1f)[:, None]
+    full = 255 * 256 # brightest channel value at the chosen global brightness
+    bn = (light.max(axis=1) + full - 1) // full
+    light //= np.maximum(bn, 1)[:, None]
+    light += self.err
+    rounded = (light + 128) >> 8
+    np.clip(rounded, 0, 255, out=rounded)
+    np.subtract(light, rounded << 8, out=self.err)
+    out[:, 0] = bn | LED_START
+    out[:, 1:] = rounded
+    self.residual = bool(self.err.any())
@@ -0,0 +1,184 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Daemon config: defaults, command line, config file and the per-strip configs"""
+
+import os
+from copy import deepcopy
+from argparse import ArgumentParser, RawTextHelpFormatter
+
+# config order (later overwrites newer)
+# 1. default cfg
+# 2. config file
+# 3. cmdline args
+# 4. runtime cfg via MQTT $host/sensors/$name/config
+
+NAME = "APA102" # Uppercase
+DEFAULTS = {
+    "interval": 0.3,
+    "fps": 10, # frame rate of error wheel & animations
+    "fade_s": 0, # fade to new values within this time, 0: switch immediately
+    "gamma": 1, # gamma correction, one value or [r, g, b], 1: linear
+    "dither": False, # temporal dithering for smooth dim colors, refreshes every frame, at least 50 fps
+    "bus": 0,
+    "address": 0,
+    "busfreq": 400000,
+    "output": "spi", # or sim: simulated strip, no hardware needed
+    "simfile": "", # sim: write every decoded frame to this file / pipe, - for stdout
+    "brokerhost": "localhost",
+    "stream_port": 0, # DDP frames over UDP on this port (DDP's own: 4048), 0: off
+    "stream_bind": "", # address the stream port listens on, "": all
+    "stream_socket": "", # DDP frames over a Unix datagram socket at this path, "": off
+    "shm_dir": "", # shared memory framebuffer of each strip in this directory (e.g. /dev/shm), "": off
+    "leds": 1,
+    "timeout_s": 3,
+    "brightness": 100,
+    "max_brightness": 4, # 5 bit global brightness of brightness 100, up to 31; 4 is the level of earlier versions
+    "fixed": 0,
+    "skip": 0, # for our 8-led boards, skip # after the 1st
+    "runtime": "threads", # or asyncio: everything on one event loop
+    "selftest": True, # red, green, blue at startup, shown while MQTT connects
+    "metrics_s": 60, # publish runtime metrics every n seconds, 0: never
+    "trace": 4096, # records of hot path timing kept for SIGUSR1, 0: off
+    "tracefile": "/tmp/" + NAME.lower() + "-trace.txt", # SIGUSR1 dumps the records here, the profile to .prof
+    "profile_s": 0, # SIGUSR1 also runs cProfile for n seconds, 0: no profile
+    "configfile": "/etc/lcars/" + NAME.lower() + ".yml",
+    "cachefile": "/var/cache/lcars/" + NAME.lower() + ".cache", # compiled config, "" to disable
+    "colors": {
+        "green": 0x00FF00,
+        "yellow": 0xFFAA00,
+        "orange": 0xFF3300,
+        "red": 0xFF0000,
+        "blue": 0x0000FF
+      }
+    }
+
+def argParser(cfg=DEFAULTS):
+  parser = ArgumentParser(description=NAME + ' driver.\n\nDefaults in {curly braces}',formatter_class=RawTextHelpFormatter)
+  parser.add_argument("-i", "--interval", type=float, default=cfg['interval'],
+                              help="check interval in s (float, default "+str(cfg['interval'])+")", metavar="x")
+  parser.add_argument("-F", "--fps", type=float, default=cfg['fps'],
+                              help="target frame rate of animations {"+str(cfg['fps'])+"}", metavar="n")
+  parser.add_argument("-D", "--debug", action='store_true', #cmdline arg only, not in config
+                              help="print debug messages")
+
+  parser.add_argument("-b", "--bus", type=int, default=cfg['bus'], choices=[0,1,2,3,4,5,6],
+                              help="spi bus # (/dev/spidev[0-6], {"+str(cfg['bus'])+"} )", metavar="n")
+  parser.add_argument("-a", "--address", type=int, default=cfg['address'], choices=[0,1,2],
+                              help="spi cs line 0-2 {"+str(cfg['address'])+"}", metavar="i")
+  parser.add_argument("-s", "--busfreq", type=int, default=cfg['busfreq'],
+                              help="bus frequenzy {"+str(cfg['busfreq'])+"} Hz", metavar="f")
+
+  parser.add_argument("-O", "--output", type=str, default=cfg['output'], choices=['spi', 'sim'],
+                              help="spi bus or simulated strip {"+cfg['output']+"}", metavar="out")
+  parser.add_argument("--simfile", type=str, default=cfg['simfile'],
+                              help="sim: write decoded frames to file/pipe, - for stdout", metavar="path")
+
+  parser.add_argument("-o", "--brokerhost", type=str, default=cfg['brokerhost'],
+                              help="use mqtt broker (addr: {"+cfg['brokerhost']+"})", metavar="addr")
+
+  parser.add_argument("--stream-port", dest='stream_port', type=int, default=cfg['stream_port'],
+                              help="DDP frame stream on this UDP port, 0: off {"+str(cfg['stream_port'])+"}", metavar="port")
+  parser.add_argument("--stream-socket", dest='stream_socket', type=str, default=cfg['stream_socket'],
+                              help="DDP frame stream on this Unix datagram socket", metavar="path")
+  parser.add_argument("--shm-dir", dest='shm_dir', type=str, default=cfg['shm_dir'],
+                              help="shared memory framebuffers of the strips in this directory", metavar="dir")
+
+  parser.add_argument("-f", "--fixed", type=int, default=cfg['fixed'],
+                              help="# of fixed leds, {"+str(cfg['fixed'])+"} )", metavar="n")
+
+  parser.add_argument("-r", "--runtime", type=str, default=cfg['runtime'], choices=['threads', 'asyncio'],
+                              help="threads or asyncio event loop {"+cfg['runtime']+"}", metavar="rt")
+  parser.add_argument("-M", "--metrics", dest='metrics_s', type=float, default=cfg['metrics_s'],
+                              help="publish metrics every n s, 0: off {"+str(cfg['metrics_s'])+"}", metavar="n")
+  parser.add_argument("--trace", type=int, default=cfg['trace'],
+                              help="hot path timing records for SIGUSR1, 0: off {"+str(cfg['trace'])+"}", metavar="n")
+  parser.add_argument("--profile", dest='profile_s', type=float, default=cfg['profile_s'],
+                              help="SIGUSR1 also profiles for n s {"+str(cfg['profile_s'])+"}", metavar="n")
+  parser.add_argument("-T", "--no-selftest", dest='selftest', action='store_false', default=cfg['selftest'],
+                              help="no red/green/blue test at startup")
+
+  parser.add_argument("-c", "--configfile", type=str, default=cfg['configfile'],
+                              help="load configfile ("+cfg['configfile']+")", metavar="nn")
+  parser.add_argument("--cachefile", type=str, default=cfg['cachefile'],
+                              help="cache of the compiled config, '' to disable ("+cfg['cachefile']+")", metavar="path")
+  return parser
+
+def loadConfigFile(path, cache=None):
+  """settings of a YAML config file, None if there is no readable file. cache: a ConfigCache of path"""
+  if not (os.path.isfile(path) and os.access(path, os.R_OK)):
+    return None
+  filecfg = cache and cache.fileConfig()
+  if filecfg is not None:
+    print("configfile", path, "unchanged, settings from cache")
+    return filecfg
+  import yaml # only needed with a changed config file
+  with open(path, 'r') as ymlfile:
+    filecfg = yaml.safe_load(ymlfile) or {}
+  cache and cache.storeFileConfig(deepcopy(filecfg))
+  return filecfg
+
+def buildConfig(args, defaults=DEFAULTS, cache=None):
+  """final config from defaults, config file and command line (argparse Namespace)"""
+  debug = getattr(args, 'debug', False)
+  fcfg = deepcopy(defaults) # final config used
+  filecfg = loadConfigFile(args.configfile, cache)
+  if filecfg is not None:
+    print("opened configfile", args.configfile)
+    for key in defaults:
+      if key in filecfg:
+        value = filecfg[key]
+        fcfg[key] = value
+        print("used file setting", key, value)
+    for key in filecfg:
+      if not key in defaults:
+        value = filecfg[key]
+        fcfg[key] = value
+        print("loaded file setting", key, value)
+  else:
+    print("no configfile found at", args.configfile)
+  debug and print('config from default & file', fcfg)
+
+  argdict = vars(args)
+  for key in defaults:
+    if key in argdict and argdict[key] != defaults[key]:
+      value = argdict[key]
+      fcfg[key] = value
+      print('cmdline param', key, 'used with', value)
+
+  required_params = ['brokerhost']
+  for param in required_params:
+    if not param in fcfg or not fcfg[param]:
+      raise ValueError('param ' + param + ' missing from config')
+  return fcfg
+
+def stripConfigs(cfg):
+  """
+  [(name, cfg)] of all strips. strips: list of per-strip settings, missing
+  keys are taken from the top level. Without strips, the top level config
+  describes the only strip.
+  """
+  strip_cfgs = cfg['strips'] if 'strips' in cfg else [{}]
+  result = []
+  for i in range(len(strip_cfgs)):
+    scfg = deepcopy(cfg)
+    scfg.pop('strips', None)
+    scfg.update(deepcopy(strip_cfgs[i]))
+    sname = scfg['name'] if 'name' in scfg else 'spidev' + str(scfg['bus']) + '.' + str(scfg['address'])
+    result.append((sname, scfg))
+  return result
@@ -0,0 +1,305 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The daemon: strips, MQTT, stream and framebuffer input, startup test, readiness and watchdog"""
+
+import os
+import time
+import signal
+import threading
+from copy import deepcopy
+from subprocess import call
+
+from .config import NAME, stripConfigs
+from .strip import Strip, eprint
+from .mqtt import MqttInput
+from .metrics import publishMetrics
+from .trace import tracer
+
+SPIDEV_TEST = "/usr/local/bin/spidev_test"
+LIVE_KEYS = ('metrics_s', 'trace', 'tracefile', 'profile_s') # read by the daemon when used, no restart
+
+class Daemon(object):
+  """
+  Built from a final config (see config.buildConfig), construction only
+  compiles the strips. run() opens the outputs, shows the first frame,
+  connects MQTT in the background and feeds the systemd watchdog until
+  stop(). READY=1 is sent as soon as every strip has its first frame out.
+  notify: e.g. sdnotify's SystemdNotifier().notify, optional.
+  load_config: returns the config again from its sources, for SIGHUP.
+  cache: a ConfigCache to take the compiled strips from / store them in.
+  Settings sent to $host/sensors/APA102/config (JSON) overwrite the loaded
+  ones until the next restart; both are applied to the running strips.
+  Every metrics_s the strips' metrics go to $host/sensors/APA102/metrics.
+  SIGUSR1 dumps the hot path timing to tracefile and profiles profile_s.
+  With stream_port / stream_socket, frames streamed in DDP are shown too,
+  with shm_dir the frames local processes write to a strip's framebuffer.
+  """
+
+  __slots__ = ('cfg', 'debug', 'notify', 'strips', 'mqtt', 'stream', 'shm', 'running', 'ready', 'interval', 'runtime', 'metrics_topic', 'metrics_next',
+    'load_config', 'runtime_cfg', 'config_topic', 'reload_lock', 'reload_requested', 'trace_requested')
+
+  def __init__(self, cfg, notify=None, hostname=None, load_config=None, cache=None, debug=False):
+    self.cfg = cfg
+    self.debug = debug
+    self.notify = notify or (lambda state: None)
+    self.load_config = load_config
+    self.runtime_cfg = {} # settings received via MQTT
+    self.reload_lock = threading.RLock() # SIGHUP and MQTT reloads one after the other
+    self.reload_requested = False
+    self.trace_requested = False
+    cfg['trace'] != tracer.size and tracer.resize(cfg['trace'])
+    hostname = hostname or os.uname()[1]
+    self.config_topic = '/'.join([hostname, 'sensors', NAME, 'config'])
+    self.metrics_topic = '/'.join([hostname, 'sensors', NAME, 'metrics'])
+    self.metrics_next = time.monotonic() + cfg['metrics_s']
+    self.strips = []
+    for (sname, scfg) in stripConfigs(cfg):
+      key = cache and cache.stripKey(sname, scfg, debug)
+      state = cache and cache.strip(key)
+      strip = Strip(sname, scfg, hostname, debug=debug, state=state)
+      if cache and not state:
+        cache.storeStrip(key, strip.renderState())
+      self.strips.append(strip)
+      self.notify("WATCHDOG=1")
+    cache and cache.save()
+    self.mqtt = None
+    self.stream = None
+    self.shm = None
+    self.running = False
+    self.ready = False
+    self.interval = cfg['interval']
+    self.runtime = None # the AsyncRuntime with runtime asyncio
+
+  def open(self):
+    """opens the outputs and sends the first frame: the startup test or a blank strip"""
+    writer = self.cfg['runtime'] == 'threads' # asyncio: transfers run in the loop's executors
+    if any(strip.cfg['output'] == 'spi' for strip in self.strips) and os.access(SPIDEV_TEST, os.X_OK):
+      call([SPIDEV_TEST, "-N"]) #disable SPI0-CS, done before any frame is on the bus
+    now = time.monotonic()
+    for strip in self.strips:
+      strip.open(writer=writer)
+      print("using", strip)
+      if self.cfg['selftest']:
+        strip.selfTest(now)
+      else:
+        strip.clearStrip() # known state instead of the power-up colors
+      writer or strip.writeReady()
+
+  def openStream(self):
+    """the DDP stream input if a port or socket is configured, else None"""
+    cfg = self.cfg
+    if not (cfg['stream_port'] or cfg['stream_socket']):
+      return None
+    from .stream import StreamInput
+    try:
+      return StreamInput(self.strips, cfg['stream_port'], cfg['stream_bind'], cfg['stream_socket'], debug=self.debug)
+    except OSError as e: # the sensor values still get shown
+      eprint('stream input not opened:', e)
+      return None
+
+  def openShm(self):
+    """the shared memory framebuffers if shm_dir is configured, else None"""
+    if not self.cfg['shm_dir']:
+      return None
+    from .shm import ShmInput
+    try:
+      return ShmInput(self.strips, self.cfg['shm_dir'], debug=self.debug)
+    except OSError as e:
+      eprint('framebuffers not opened:', e)
+      return None
+
+  def checkReady(self):
+    """sends READY=1 once every strip has its first frame out"""
+    if not self.ready and all(strip.first_frame.is_set() for strip in self.strips):
+      self.ready = True
+      self.notify("READY=1")
+      print("ready, first frames out")
+    return self.ready
+
+  def tick(self):
+    """periodic work of the main loop besides the watchdog"""
+    metrics_s = self.cfg['metrics_s']
+    now = time.monotonic()
+    if metrics_s and now >= self.metrics_next and self.mqtt:
+      self.metrics_next = now + metrics_s
+      publishMetrics(self.mqtt.client, self.metrics_topic, self.strips, now)
+    path = self.cfg['tracefile'] + '.prof'
+    stats = tracer.finishProfile(path)
+    if stats is not None:
+      print("profile written to", path)
+      stats.sort_stats('cumulative').print_stats(15)
+
+  def dumpTrace(self, signum=None, frame=None):
+    """SIGUSR1: hot path timing to tracefile and its percentiles to stdout, starts the profile"""
+    path = self.cfg['tracefile']
+    try:
+      lines = tracer.dump(path)
+    except OSError as e:
+      eprint('trace not written:', e)
+      return
+    print("trace written to", path)
+    for line in lines:
+      print(line)
+    profile_s = self.cfg['profile_s']
+    if profile_s > 0 and tracer.profile_until is None:
+      print("profiling for", profile_s, "s")
+      tracer.startProfile(profile_s)
+
+  def requestTrace(self, signum=None, frame=None):
+    """SIGUSR1 handler, the dump runs in the main loop"""
+    self.trace_requested = True
+
+  # --- config reload ---
+
+  def reload(self, cfg):
+    """
+    applies a new config to the running strips: each compiles what changed
+    aside and swaps it in on its next frame, MQTT stays connected
+    """
+    with self.reload_lock:
+      strips = dict((strip.name, strip) for strip in self.strips)
+      for (sname, scfg) in stripConfigs(cfg):
+        if not sname in strips:
+          eprint(sname, 'is a new strip, needs a restart')
+          continue
+        try:
+          state = strips[sname].compileConfig(scfg, ignore=LIVE_KEYS)
+        except Exception as e:
+          eprint(sname, 'config not applied:', repr(e))
+          continue
+        state and strips[sname].postConfig(state)
+      cfg['trace'] != tracer.size and tracer.resize(cfg['trace'])
+      self.interval = cfg['interval'] # watchdog and main loop pace, taken on their next round
+      if self.runtime:
+        self.runtime.interval = self.interval
+      self.cfg = cfg
+
+  def reloadFile(self):
+    """SIGHUP: config from its sources again, plus the settings received via MQTT"""
+    if not self.load_config:
+      eprint('no config source to reload from')
+      return
+    print('reloading config')
+    try:
+      cfg = self.load_config()
+    except Exception as e:
+      eprint('config not reloaded:', repr(e))
+      return
+    with self.reload_lock:
+      cfg.update(deepcopy(self.runtime_cfg))
+      self.reload(cfg)
+
+  def onConfig(self, settings):
+    """settings from the MQTT config topic, on top of the current config"""
+    if not isinstance(settings, dict):
+      eprint('config message is no dict, ignored:', settings)
+      return
+    print('config via mqtt:', settings)
+    with self.reload_lock:
+      self.runtime_cfg.update(settings)
+      cfg = deepcopy(self.cfg)
+      cfg.update(deepcopy(settings))
+      self.reload(cfg)
+
+  def requestReload(self, signum=None, frame=None):
+    """SIGHUP handler, the reload runs in the main loop"""
+    self.reload_requested = True
+
+  def start(self):
+    """threads runtime: outputs, MQTT thread and strip threads, returns at once"""
+    self.open()
+    self.mqtt = MqttInput(self.cfg['brokerhost'], self.strips, NAME, self.config_topic, self.onConfig, debug=self.debug)
+    self.mqtt.start()
+    self.stream = self.openStream()
+    self.stream and self.stream.start()
+    self.shm = self.openShm()
+    self.shm and self.shm.start()
+    for strip in self.strips:
+      strip.start()
+    self.running = True
+
+  def stop(self, signum=None, frame=None):
+    """ends run(), also usable as signal handler"""
+    print("exit gracefully...")
+    self.running = False
+
+  def shutdown(self):
+    self.stream and self.stream.stop()
+    self.shm and self.shm.stop()
+    print("waiting for threads... ", end='')
+    for strip in self.strips:
+      strip.stop()
+    print("finishing")
+    self.mqtt and self.mqtt.stop()
+    self.clearStrips()
+
+  def clearStrips(self):
+    for strip in self.strips:
+      strip.clearStrip()
+      out = strip.out
+      strip.close()
+      hasattr(out, 'stats') and print(strip.name, out.stats())
+      print(strip.name, "frames sent:", strip.frames_sent, "skipped (unchanged):", strip.frames_skipped, "dropped (replaced):", strip.frames_dropped)
+      print(strip.name, "values received:", strip.values_received, "rendered:", strip.values_rendered, "coalesced:", strip.values_coalesced)
+      strip.scheduler and print(strip.name, strip.scheduler.stats())
+
+  def watchdog(self):
+    # the strips run in their own threads, here only the watchdog is kept alive
+    while self.running:
+      t0 = time.perf_counter()
+      tracer.profilePoint()
+      self.checkReady()
+      if self.reload_requested:
+        self.reload_requested = False
+        self.reloadFile()
+      if self.trace_requested:
+        self.trace_requested = False
+        self.dumpTrace()
+      self.tick()
+      if all(strip.isAlive() for strip in self.strips):
+        self.notify("WATCHDOG=1")
+      else:
+        eprint("strip thread died, not feeding watchdog")
+      tracer.add('main', None, t0, time.perf_counter())
+      time.sleep(self.interval)
+    print("main thread finished")
+
+  def run(self):
+    if self.cfg['runtime'] == 'asyncio':
+      from .aio import AsyncRuntime
+      self.open()
+      self.mqtt = MqttInput(self.cfg['brokerhost'], self.strips, NAME, self.config_topic, self.onConfig, debug=self.debug)
+      self.stream = self.openStream()
+      self.shm = self.openShm()
+      self.runtime = AsyncRuntime(self.mqtt.client, self.cfg['brokerhost'], self.mqtt.topics(), self.strips, self.notify, self.interval, signals={signal.SIGHUP: self.reloadFile, signal.SIGUSR1: self.dumpTrace}, tick=self.tick, stream=self.stream, shm=self.shm, debug=self.debug)
+      self.runtime.run()
+      self.stream and self.stream.stop()
+      self.shm and self.shm.stop()
+      self.clearStrips()
+      return
+
+    signal.signal(signal.SIGINT, self.stop)
+    signal.signal(signal.SIGTERM, self.stop)
+    signal.signal(signal.SIGHUP, self.requestReload)
+    signal.signal(signal.SIGUSR1, self.requestTrace)
+    self.start()
+    for strip in self.strips:
+      strip.first_frame.wait(1)
+    self.watchdog()
+    self.shutdown()
@@ -0,0 +1,128 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Message dispatch: topic -> tag filter -> value -> strip, compiled into an index once"""
+
+import json
+import time
+
+from .trace import tracer
+
+INDEX_MAX = 1024 # topics resolved through wildcards kept in the index, then it starts over
+
+def isFilter(topic):
+  """True if topic has MQTT wildcards"""
+  return '+' in topic or '#' in topic
+
+def topicMatches(topic_filter, topic):
+  """MQTT matching of a topic against a subscription filter with + and #"""
+  flevels = topic_filter.split('/')
+  tlevels = topic.split('/')
+  for (i, flevel) in enumerate(flevels):
+    if flevel == '#':
+      return True
+    if i >= len(tlevels) or (flevel != '+' and flevel != tlevels[i]):
+      return False
+  return len(flevels) == len(tlevels)
+
+def tagFilter(tags):
+  """
+  (keys, items) a message's tags have to contain: a tag with value '+' only
+  has to be there, any other value has to be equal. Checked with two set
+  comparisons of the tags' dict views, no loop in Python.
+  """
+  keys = frozenset(tags)
+  items = frozenset((key, value) for (key, value) in tags.items() if value != '+')
+  return (keys, items)
+
+class Dispatcher(object):
+  """
+  The bindings of all strips, compiled once: topic -> [(tag keys, tag items,
+  value key or tuple of keys of a strip's segments, strip)]. A message costs one dict lookup for its topic, one
+  JSON decode if anyone wants it and per binding two set comparisons and a
+  dict lookup, whatever the number of topics and bindings. Targets with
+  wildcards are matched once per new topic, a matching one goes into the
+  index; past INDEX_MAX of them the index is reset to the exact topics,
+  so endless topic names under a # filter cannot grow it without bound.
+  """
+
+  __slots__ = ('bindings', 'wildcards', 'exact', 'index', 'debug')
+
+  def __init__(self, strips, debug=False):
+    self.debug = debug
+    self.bindings = [] # (topic or filter, binding)
+    for strip in strips:
+      for (topic, tags, valuekey) in strip.bindings():
+        (keys, items) = tagFilter(tags)
+        self.bindings.append((topic, (keys, items, valuekey, strip)))
+    self.wildcards = [(topic, binding) for (topic, binding) in self.bindings if isFilter(topic)]
+    self.exact = {} # topics of the bindings without wildcards, always in the index
+    self.index = {}
+    for topic in self.topics():
+      isFilter(topic) or self.resolve(topic)
+    self.exact = dict(self.index)
+
+  def topics(self):
+    """the topics and filters to subscribe to, each once"""
+    topics = []
+    for (topic, binding) in self.bindings:
+      if not topic in topics:
+        topics.append(topic)
+    return topics
+
+  def resolve(self, topic):
+    """all bindings for a topic, exact ones and matching wildcards, stored in the index if there are any"""
+    bindings = [binding for (t, binding) in self.bindings if t == topic]
+    bindings += [binding for (topic_filter, binding) in self.wildcards if topicMatches(topic_filter, topic)]
+    bindings = tuple(bindings)
+    if bindings:
+      if len(self.index) >= len(self.exact) + INDEX_MAX:
+        self.index = dict(self.exact)
+      self.index[topic] = bindings
+    return bindings
+
+  def dispatch(self, topic, payload):
+    """decodes a message (JSON bytes) once and posts its value to each strip bound to it"""
+    bindings = self.index.get(topic)
+    if bindings is None:
+      bindings = self.resolve(topic)
+    if not bindings:
+      return
+    t0 = time.perf_counter()
+    message = json.loads(payload)
+    t1 = time.perf_counter()
+    tracer.add('decode', None, t0, t1)
+    msgtags = message.get('tags', {})
+    values = message.get('values', {})
+    for (keys, items, valuekey, strip) in bindings:
+      if keys and not (msgtags.keys() >= keys and msgtags.items() >= items):
+        strip.values_filtered += 1
+        self.debug and print(strip.name, 'tags', msgtags, 'do not match, ignored')
+        continue
+      if valuekey.__class__ is tuple: # a strip with segments: all their values at once
+        value = tuple(map(values.get, valuekey))
+        if value.count(None) == len(value):
+          value = None
+      else:
+        value = values.get(valuekey)
+      if value is None:
+        strip.values_filtered += 1
+        self.debug and print(strip.name, 'value', valuekey, 'not found in msg values, ignored')
+        continue
+      strip.post(value) # rendered in the strip's own thread / task
+    tracer.add('dispatch', None, t1, time.perf_counter())
@@ -0,0 +1,71 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Smooth transitions between frames, computed with NumPy over the whole strip"""
+
+import numpy as np
+
+class Fade(object):
+  """
+  Linear blend from the frame on the strip to a new target frame over
+  duration seconds. Works on the encoded pixels (header, blue, green, red):
+  the header is 0xE0 | 5 bit brightness in both frames, so blending the
+  header byte blends the global brightness along with the colors.
+  A new target while fading starts from the currently shown blend.
+  """
+
+  __slots__ = ('duration', 'start', 'delta', 'blend', 'target', 'begin_at', 'active', 'dirty_leds')
+
+  def __init__(self, nleds, duration):
+    self.duration = duration
+    self.start = np.zeros(4 * nleds, dtype=np.int32)
+    self.delta = np.zeros(4 * nleds, dtype=np.int32)
+    self.blend = np.zeros(4 * nleds, dtype=np.int32)
+    self.target = np.zeros(4 * nleds, dtype=np.uint8)
+    self.begin_at = 0.0
+    self.active = False
+    self.dirty_leds = 0 # LEDs 0 .. dirty_leds-1 change during this fade
+
+  def begin(self, current, target, now):
+    """current, target: encoded pixel buffers (4 bytes per LED)"""
+    cur = np.frombuffer(current, dtype=np.uint8)
+    self.target[:] = np.frombuffer(target, dtype=np.uint8)
+    self.start[:] = cur
+    np.subtract(self.target, cur, out=self.delta, dtype=np.int32)
+    changed = np.flatnonzero(self.delta)
+    if len(changed) == 0:
+      self.active = False
+      return
+    self.dirty_leds = int(changed[-1]) // 4 + 1
+    self.begin_at = now
+    self.active = True
+
+  def step(self, now, out):
+    """writes the blend for now into out (encoded pixel buffer), returns False when done"""
+    x = max(now - self.begin_at, 0.0) / self.duration
+    out_np = np.frombuffer(out, dtype=np.uint8)
+    if x >= 1.0:
+      out_np[:] = self.target
+      self.active = False
+      return False
+    # fixed point 8.8 weight, all in place on preallocated arrays
+    np.multiply(self.delta, int(x * 256), out=self.blend)
+    np.right_shift(self.blend, 8, out=self.blend)
+    np.add(self.blend, self.start, out=self.blend)
+    out_np[:] = self.blend
+    return True
@@ -0,0 +1,78 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Runtime metrics of the strips: counters and histograms, snapshots in the sensor message format"""
+
+import json
+from bisect import bisect_left
+
+HIST_BOUNDS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class Histogram(object):
+  """fixed buckets (upper bounds in ms, one more for everything above), adding is one bisect"""
+
+  __slots__ = ('bounds', 'counts', 'n', 'total', 'max')
+
+  def __init__(self, bounds=HIST_BOUNDS_MS):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.n = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, ms):
+    self.counts[bisect_left(self.bounds, ms)] += 1
+    self.n += 1
+    self.total += ms
+    if ms > self.max:
+      self.max = ms
+
+  def snapshot(self, prefix, values):
+    """adds count, mean, max and the buckets (cumulative since start) to values"""
+    values[prefix + '_n'] = self.n
+    values[prefix + '_ms_mean'] = round(self.total / self.n, 3) if self.n else 0
+    values[prefix + '_ms_max'] = round(self.max, 3)
+    buckets = dict((str(bound), count) for (bound, count) in zip(self.bounds, self.counts))
+    buckets['inf'] = self.counts[-1]
+    values[prefix + '_ms_hist'] = buckets
+
+def stripMetrics(strip, now):
+  """one strip's counters as a message like the sensors send: tags and values"""
+  values = {
+    'values_received': strip.values_received,
+    'values_filtered': strip.values_filtered,
+    'values_rendered': strip.values_rendered,
+    'values_coalesced': strip.values_coalesced,
+    'frames_sent': strip.frames_sent,
+    'frames_skipped': strip.frames_skipped,
+    'frames_dropped': strip.frames_dropped,
+    'timeouts': strip.timeouts,
+    'timeout_total_s': round(strip.error_s + (now - strip.error_since if strip.error_since is not None else 0), 3),
+    'in_timeout': strip.error_since is not None,
+  }
+  strip.spi_hist.snapshot('spi', values)
+  strip.latency_hist.snapshot('latency', values)
+  if strip.scheduler:
+    values['frame_overruns'] = strip.scheduler.overruns
+    values['frames_missed'] = strip.scheduler.frames_missed
+  return {'tags': {'strip': strip.name}, 'values': values}
+
+def publishMetrics(client, topic, strips, now):
+  """one message per strip on topic via a paho client"""
+  for strip in strips:
+    client.publish(topic, json.dumps(stripMetrics(strip, now)))
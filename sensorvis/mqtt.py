@@ -0,0 +1,127 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""MQTT input: subscribes to the strips' topics and posts the values to them"""
+
+import json
+import time
+import threading
+
+from .strip import eprint
+from .dispatch import Dispatcher
+from .trace import tracer
+
+class MqttInput(object):
+  """
+  One broker connection for all strips. paho is imported on construction,
+  not with the package. start() connects in the MQTT thread, so the strips
+  show their first frame without waiting for the broker.
+  """
+
+  __slots__ = ('brokerhost', 'dispatcher', 'config_topic', 'on_config', 'client', 'debug', 'thread')
+
+  def __init__(self, brokerhost, strips, client_id, config_topic=None, on_config=None, debug=False):
+    """on_config(settings): called with the decoded JSON of each message on config_topic"""
+    import paho.mqtt.client as mqtt
+    self.brokerhost = brokerhost
+    self.config_topic = config_topic
+    self.on_config = on_config
+    self.debug = debug
+    self.dispatcher = Dispatcher(strips, debug=debug)
+    # client id only useful if subscribing, but nice in logs # clean_session if you don't want to collect messages if daemon stops
+    self.client = mqtt.Client(client_id=client_id, clean_session=True)
+    self.client.on_connect = self.onConnect
+    self.client.on_disconnect = self.onDisconnect
+    self.client.on_message = self.onMessage
+    self.thread = None
+
+  def topics(self):
+    topics = self.dispatcher.topics()
+    if self.config_topic:
+      topics.append(self.config_topic)
+    return topics
+
+  def onConnect(self, client, userdata, flags, rc):
+    try:
+      if rc != 0:
+        eprint('mqtt: failure on connect to broker "'+ self.brokerhost+ '", result code:', str(rc))
+        if rc == 3:
+          eprint('mqtt: broker "'+ self.brokerhost+ '" unavailable')
+      else:
+        print("mqtt: Connected to broker", self.brokerhost, "with result code", str(rc))
+        for subscribe_topic in self.topics():
+          client.subscribe(subscribe_topic)
+          print("mqtt: subscribing to", subscribe_topic)
+        return
+    except Exception as e:
+      eprint('mqtt: Exception in onConnect', e)
+    self.connect()
+
+  def onDisconnect(self, client, userdata, rc):
+    if rc != 0:
+      print("mqtt: Unexpected disconnection.")
+      self.reconnect()
+
+  def onMessage(self, client, userdata, msg):
+    tracer.profilePoint() # paho's thread with the threads runtime, the event loop with asyncio
+    try:
+      self.debug and print( msg.topic, msg.payload.decode())
+      if msg.topic == self.config_topic:
+        self.on_config(json.loads(msg.payload.decode()))
+        return
+      self.dispatcher.dispatch(msg.topic, msg.payload)
+    except Exception as e:
+      eprint(e)
+
+  def connect(self):
+    while True:
+      try:
+        print("mqtt: Connecting to", self.brokerhost)
+        self.client.connect(self.brokerhost,1883,60)
+        print('mqtt: connect successful')
+        break
+      except Exception as e:
+        eprint('mqtt: Exception in client.connect to "' + self.brokerhost + '", E:', e)
+        print('mqtt: next connect attempt in 3s... ', end='')
+        time.sleep(3)
+        print('retry.')
+
+  def reconnect(self):
+    print('mqtt: attempting reconnect')
+    while True:
+      try:
+        self.client.reconnect()
+        print('mqtt: reconnect successful')
+        break
+      except ConnectionRefusedError as e:
+        eprint('mqtt: ConnectionRefusedError', e, '\nnext attempt in 3s')
+        time.sleep(3)
+
+  def run(self):
+    self.connect()
+    self.client.loop_forever()
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name='mqtt', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.client.disconnect()
+    if self.thread:
+      self.thread.join(1)
+      self.thread = None
@@ -0,0 +1,144 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Output backends of a strip: the SPI bus or a simulated strip without hardware"""
+
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+from .color import LED_START
+
+SPIDEV_BUFSIZ = '/sys/module/spidev/parameters/bufsiz' # max. bytes per transfer of the kernel driver
+
+def spidevBufsiz():
+  try:
+    with open(SPIDEV_BUFSIZ) as f:
+      return int(f.read())
+  except (OSError, ValueError):
+    return 4096 # kernel default
+
+class SpiOutput(object):
+  """
+  /dev/spidev<bus>.<address>. The driver takes at most bufsiz bytes per
+  transfer, longer strips need several. The clock simply pauses between
+  them, APA102 have no timing to violate.
+  """
+
+  __slots__ = ('spi', 'bufsiz', 'spi_write')
+
+  def __init__(self, bus, address, busfreq):
+    import spidev # only needed on the Pi
+    spi = spidev.SpiDev()
+    spi.open(bus, address)
+    spi.max_speed_hz = busfreq
+    spi.mode = 1
+    self.spi = spi
+    self.bufsiz = spidevBufsiz()
+    if hasattr(spi, 'writebytes2'): # spidev >= 3.4: takes any buffer, no list copy, splits by bufsiz itself
+      self.spi_write = spi.writebytes2
+    else:
+      print('spidev without writebytes2, falling back to list copies', file=sys.stderr)
+      self.spi_write = self.writeChunks
+
+  def write(self, buf):
+    self.spi_write(buf)
+
+  def writeChunks(self, buf):
+    """older spidev: writebytes() of lists, at most bufsiz (and 4096 in old versions) bytes each"""
+    chunk = min(self.bufsiz, 4096)
+    for pos in range(0, len(buf), chunk):
+      self.spi.writebytes(list(buf[pos:pos + chunk]))
+
+  def close(self):
+    self.spi.close()
+
+class SimOutput(object):
+  """
+  A simulated strip: decodes the APA102 byte stream like the LEDs do and
+  keeps their state as (red, green, blue, 5 bit brightness) per LED in
+  leds, with the receive time of every frame in times. With a path (a file,
+  a named pipe or '-' for stdout) every frame is also written as one line:
+  monotonic timestamp, LEDs updated, and the state of all LEDs as hex,
+  4 bytes per LED: red, green, blue, brightness.
+  """
+
+  __slots__ = ('nleds', 'leds', 'times', 'frames', 'errors', 'out')
+
+  def __init__(self, nleds, path=None, keep=100000):
+    self.nleds = nleds
+    self.leds = np.zeros((nleds, 4), dtype=np.uint8) # unknown power-up state, shown as off
+    self.times = deque(maxlen=keep) # receive time of the last frames
+    self.frames = 0
+    self.errors = 0
+    self.out = None
+    if path == '-':
+      self.out = sys.stdout
+    elif path:
+      self.out = open(path, 'w')
+
+  def write(self, buf):
+    now = time.monotonic()
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if len(data) < 4 or data[:4].any():
+      self.errors += 1 # no start frame, the LEDs would not take it
+      return
+    nleds = min((len(data) - 4) // 4, self.nleds)
+    pixels = data[4:4 + 4 * nleds].reshape(-1, 4)
+    # every LED takes one frame with the three start bits, the first without ends the data
+    invalid = np.flatnonzero(pixels[:, 0] & LED_START != LED_START)
+    if len(invalid):
+      nleds = int(invalid[0])
+      pixels = pixels[:nleds]
+    leds = self.leds[:nleds]
+    leds[:, 0] = pixels[:, 3] # red
+    leds[:, 1] = pixels[:, 2] # green
+    leds[:, 2] = pixels[:, 1] # blue
+    leds[:, 3] = pixels[:, 0] & 0x1f
+    self.frames += 1
+    self.times.append(now)
+    if self.out:
+      self.out.write("%.6f %d %s\n" % (now, nleds, self.leds.tobytes().hex()))
+      self.out.flush()
+
+  def rgb(self, lednr):
+    """(red, green, blue, brightness) LED lednr shows"""
+    return tuple(int(c) for c in self.leds[lednr])
+
+  def stats(self):
+    times = self.times
+    if len(times) < 2:
+      return "sim frames: %d errors: %d" % (self.frames, self.errors)
+    gaps = np.diff(np.array(times))
+    return "sim frames: %d errors: %d fps: %.1f max gap: %.1fms" % (self.frames, self.errors, (len(times) - 1) / (times[-1] - times[0]), gaps.max() * 1000)
+
+  def close(self):
+    if self.out and self.out is not sys.stdout:
+      self.out.close()
+    self.out = None
+
+def openOutput(cfg):
+  """the backend selected by cfg['output']: 'spi' or 'sim' (optionally writing to cfg['simfile'])"""
+  kind = cfg.get('output', 'spi')
+  if kind == 'spi':
+    return SpiOutput(cfg['bus'], cfg['address'], cfg['busfreq'])
+  if kind == 'sim':
+    return SimOutput(cfg['leds'], cfg.get('simfile'))
+  raise ValueError('unknown output ' + str(kind) + ', use spi or sim')
@@ -0,0 +1,70 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Frame pacing on absolute deadlines of a monotonic clock"""
+
+import time
+
+class FrameScheduler(object):
+  """
+  Frame n is due at start + n/fps. Deadlines are absolute, so the time a
+  frame takes never shifts the following ones, and the monotonic clock is
+  not affected by NTP setting the wall clock of a Pi without RTC.
+  A frame finished after the next deadline is an overrun; the deadlines
+  that already passed are skipped instead of being rendered in a burst.
+  """
+
+  __slots__ = ('period', 'clock', 'next_frame', 'frames', 'overruns', 'frames_missed', 'max_late')
+
+  def __init__(self, fps, clock=time.monotonic):
+    if fps <= 0:
+      raise ValueError('fps must be > 0, is ' + str(fps))
+    self.period = 1.0 / fps
+    self.clock = clock
+    self.next_frame = clock()
+    self.frames = 0
+    self.overruns = 0
+    self.frames_missed = 0
+    self.max_late = 0.0
+
+  def remaining(self):
+    """seconds until the current frame is due, negative if late"""
+    return self.next_frame - self.clock()
+
+  def tick(self):
+    """current frame done, advance to the next deadline"""
+    self.frames += 1
+    self.next_frame += self.period
+    late = self.clock() - self.next_frame
+    if late > 0: # already past the next deadline: overrun
+      missed = int(late // self.period) + 1
+      self.overruns += 1
+      self.frames_missed += missed
+      self.next_frame += missed * self.period
+      if late > self.max_late:
+        self.max_late = late
+      return False
+    return True
+
+  def wait(self):
+    to_wait = self.remaining()
+    if to_wait > 0:
+      time.sleep(to_wait)
+
+  def stats(self):
+    return "frames: %d overruns: %d missed: %d max late: %.1fms" % (self.frames, self.overruns, self.frames_missed, self.max_late * 1000)
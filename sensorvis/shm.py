@@ -0,0 +1,251 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Shared memory framebuffer: local processes write the strips' pixels, the daemon sends them"""
+
+import os
+import mmap
+import time
+import fcntl
+import struct
+import threading
+
+import numpy as np
+
+from .config import NAME
+from .color import LED_START
+from .strip import eprint
+
+# segment layout, little endian: header, owner map, pixels as on the bus (brightness byte, blue, green, red)
+SHM_MAGIC = b'APA1'
+SHM_VERSION = 1
+SHM_HEADER = struct.Struct('<4sHHII') # magic, version, offset of the pixels, LEDs, sequence counter
+SHM_SEQ = struct.Struct('<I')
+SHM_SEQ_OFFSET = 12
+SHM_OWNER = struct.Struct('<III4x') # pid, first LED, LED count
+SHM_OWNERS = 16 # entries of the owner map
+SHM_OWNERS_OFFSET = SHM_HEADER.size
+SHM_PIXELS_OFFSET = SHM_OWNERS_OFFSET + SHM_OWNERS * SHM_OWNER.size
+OWNER_CHECK_S = 1 # LEDs of ended owners are switched off and freed this often
+
+def segmentPath(directory, strip_name):
+  return os.path.join(directory, NAME.lower() + '-' + strip_name)
+
+def pidAlive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError: # someone else's, but alive
+    pass
+  return True
+
+def bumpSeq(mm):
+  (seq,) = SHM_SEQ.unpack_from(mm, SHM_SEQ_OFFSET)
+  SHM_SEQ.pack_into(mm, SHM_SEQ_OFFSET, (seq + 1) & 0xFFFFFFFF)
+
+class SharedFrame(object):
+  """
+  Producer side of a strip's segment, for scripts writing to the strip the
+  daemon drives. Pixels are written inside a with block: it holds the
+  segment's lock and counts up the sequence counter at the end, which
+  makes the daemon send the frame on its next poll.
+    with SharedFrame('/dev/shm/apa102-co2') as frame:
+      frame.setPixel(0, 255, 0, 0, 31)
+  claim(first, count) takes LEDs in the owner map, optional: a claim fails
+  on LEDs of another running producer, and LEDs of a producer that ended
+  are switched off and freed by the daemon.
+  """
+
+  __slots__ = ('path', 'fd', 'mm', 'nleds', 'pixels', 'slot')
+
+  def __init__(self, path):
+    self.path = path
+    self.fd = os.open(path, os.O_RDWR)
+    self.mm = mmap.mmap(self.fd, 0)
+    (magic, version, pixels_offset, nleds, seq) = SHM_HEADER.unpack_from(self.mm)
+    if magic != SHM_MAGIC or version != SHM_VERSION:
+      self.close()
+      raise ValueError(path + ' is no ' + NAME + ' framebuffer of version ' + str(SHM_VERSION))
+    self.nleds = nleds
+    self.pixels = np.frombuffer(self.mm, dtype=np.uint8, count=4 * nleds, offset=pixels_offset).reshape(nleds, 4)
+    self.slot = None
+
+  def __enter__(self):
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    bumpSeq(self.mm)
+    fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  def seq(self):
+    return SHM_SEQ.unpack_from(self.mm, SHM_SEQ_OFFSET)[0]
+
+  def setPixel(self, lednr, red, green, blue, brightness):
+    """brightness: 0..31, the LED's 5 bit global brightness, capped at the strip's by the daemon"""
+    self.pixels[lednr] = (LED_START | brightness, blue, green, red)
+
+  def claim(self, first, count):
+    """takes LEDs first .. first+count-1, ValueError if another running producer has one of them"""
+    with self:
+      free = None
+      for slot in range(SHM_OWNERS):
+        (pid, ofirst, ocount) = SHM_OWNER.unpack_from(self.mm, SHM_OWNERS_OFFSET + slot * SHM_OWNER.size)
+        if pid == 0 or not pidAlive(pid):
+          if free is None and slot != self.slot:
+            free = slot
+        elif slot != self.slot and ofirst < first + count and first < ofirst + ocount:
+          raise ValueError('LEDs %d..%d are owned by pid %d' % (ofirst, ofirst + ocount - 1, pid))
+      slot = self.slot if self.slot is not None else free
+      if slot is None:
+        raise ValueError('no free entry in the owner map of ' + self.path)
+      SHM_OWNER.pack_into(self.mm, SHM_OWNERS_OFFSET + slot * SHM_OWNER.size, os.getpid(), first, count)
+      self.slot = slot
+
+  def release(self):
+    if self.slot is None:
+      return
+    with self:
+      SHM_OWNER.pack_into(self.mm, SHM_OWNERS_OFFSET + self.slot * SHM_OWNER.size, 0, 0, 0)
+    self.slot = None
+
+  def close(self):
+    if self.mm is None:
+      return
+    self.release()
+    self.pixels = None # the mapping can only be closed without views into it
+    self.mm.close()
+    self.mm = None
+    os.close(self.fd)
+
+class Segment(object):
+  """daemon side of one strip's segment"""
+
+  __slots__ = ('strip', 'path', 'fd', 'mm', 'pixels', 'seq')
+
+  def __init__(self, strip, path):
+    self.strip = strip
+    self.path = path
+    if os.path.exists(path): # a new file: producers still mapping the old one must not see it shrink
+      os.unlink(path)
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o666)
+    size = SHM_PIXELS_OFFSET + 4 * strip.nleds
+    os.ftruncate(self.fd, size)
+    self.mm = mmap.mmap(self.fd, size)
+    SHM_HEADER.pack_into(self.mm, 0, SHM_MAGIC, SHM_VERSION, SHM_PIXELS_OFFSET, strip.nleds, 0)
+    self.pixels = np.frombuffer(self.mm, dtype=np.uint8, count=4 * strip.nleds, offset=SHM_PIXELS_OFFSET).reshape(strip.nleds, 4)
+    self.pixels[:] = np.frombuffer(strip.off_pixel, dtype=np.uint8)
+    self.seq = 0
+
+  def close(self):
+    self.pixels = None
+    self.mm.close()
+    os.close(self.fd)
+    os.unlink(self.path)
+
+class ShmInput(object):
+  """
+  One shared memory segment per strip in directory (e.g. /dev/shm), named
+  apa102-<strip name>: header, owner map, then the pixels as on the bus.
+  poll() compares the sequence counters, a strip whose counter moved gets
+  the segment's pixels posted as frame, copied under the shared lock so
+  no half written frame is sent, their global brightness capped at the
+  strip's. A segment locked by a producer is taken on the next poll.
+  """
+
+  __slots__ = ('segments', 'period', 'next_check', 'frames', 'running', 'thread', 'debug')
+
+  def __init__(self, strips, directory, debug=False):
+    self.debug = debug
+    self.segments = []
+    for strip in strips:
+      strip.openStream()
+      segment = Segment(strip, segmentPath(directory, strip.name))
+      self.segments.append(segment)
+      print(strip.name, "framebuffer at", segment.path)
+    self.period = min(1.0 / strip.fps for strip in strips)
+    self.next_check = time.monotonic() + OWNER_CHECK_S
+    self.frames = 0
+    self.running = False
+    self.thread = None
+
+  def poll(self):
+    """posts the frames of the segments that changed since the last poll"""
+    for segment in self.segments:
+      (seq,) = SHM_SEQ.unpack_from(segment.mm, SHM_SEQ_OFFSET)
+      if seq == segment.seq:
+        continue
+      try:
+        fcntl.flock(segment.fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+      except BlockingIOError: # being written
+        continue
+      try:
+        (segment.seq,) = SHM_SEQ.unpack_from(segment.mm, SHM_SEQ_OFFSET)
+        segment.strip.postFrame(segment.pixels)
+      finally:
+        fcntl.flock(segment.fd, fcntl.LOCK_UN)
+      self.frames += 1
+    now = time.monotonic()
+    if now >= self.next_check:
+      self.next_check = now + OWNER_CHECK_S
+      self.checkOwners()
+
+  def checkOwners(self):
+    """switches off and frees the LEDs of owners that ended without release()"""
+    for segment in self.segments:
+      for slot in range(SHM_OWNERS):
+        offset = SHM_OWNERS_OFFSET + slot * SHM_OWNER.size
+        (pid, first, count) = SHM_OWNER.unpack_from(segment.mm, offset)
+        if pid == 0 or pidAlive(pid):
+          continue
+        try:
+          fcntl.flock(segment.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          continue
+        try:
+          segment.pixels[first:first + count] = np.frombuffer(segment.strip.off_pixel, dtype=np.uint8)
+          SHM_OWNER.pack_into(segment.mm, offset, 0, 0, 0)
+          bumpSeq(segment.mm)
+        finally:
+          fcntl.flock(segment.fd, fcntl.LOCK_UN)
+        print(segment.strip.name, "framebuffer: pid", pid, "ended, LEDs", first, "to", first + count - 1, "freed")
+
+  def run(self):
+    while self.running:
+      try:
+        self.poll()
+      except Exception as e:
+        eprint('framebuffer:', e)
+      time.sleep(self.period)
+
+  def start(self):
+    """threads runtime: polls in its own thread"""
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='shm', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    if self.thread:
+      self.thread.join(2)
+      self.thread = None
+    for segment in self.segments:
+      segment.close()
+    self.segments = []
+    print("framebuffer: frames:", self.frames)
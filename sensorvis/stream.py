@@ -0,0 +1,186 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Frame stream input: DDP packets over UDP and Unix datagram sockets straight into the strips"""
+
+import os
+import time
+import stat
+import socket
+import select
+import struct
+import threading
+
+import numpy as np
+
+from .strip import eprint
+from .trace import tracer
+
+DDP_PORT = 4048
+DDP_HEADER = struct.Struct('>BBBBIH') # flags, sequence, data type, destination id, byte offset, data length
+DDP_TIMECODE_LEN = 4 # behind the header if the timecode flag is set
+DDP_VERSION_MASK = 0xC0
+DDP_VERSION_1 = 0x40
+DDP_FLAG_TIMECODE = 0x10
+DDP_FLAG_QUERY = 0x02
+DDP_FLAG_PUSH = 0x01
+DDP_ID_DEFAULT = 1 # all strips as one, in config order
+DDP_ID_RESERVED = 246 # 246 - 254: control, config, status, DMX, ignored
+DDP_ID_ALL = 255 # every strip gets the same pixels
+DDP_TYPE_UNDEFINED = 0x00 # taken as RGB, 8 bit
+DDP_TYPE_RGB24 = 0x0B
+DDP_TYPE_APA102 = 0x80 # customer defined type: pixels as on the bus, brightness byte, blue, green, red
+DDP_TYPE_BPP = {DDP_TYPE_UNDEFINED: 3, DDP_TYPE_RGB24: 3, DDP_TYPE_APA102: 4} # bytes per pixel, other types are invalid
+PACKET_MAX = 65536
+
+class StreamInput(object):
+  """
+  Receives frames in DDP (Distributed Display Protocol, as sent by e.g.
+  xLights or WLED), the pixels of the packets go directly into the strips'
+  stream buffers: recv_into one preallocated packet buffer, then one
+  vectorized store per strip, no JSON and no allocation per packet.
+  A packet with the push flag completes the frame of its destination.
+  Destination id 1: all strips as one long strip in config order, 2, 3, ..:
+  the first, second, .. strip alone, 255: the same pixels on every strip.
+  Data type RGB 8 bit (or undefined): 3 bytes per pixel, sent with the
+  strip's brightness; DDP_TYPE_APA102: 4 bytes per pixel as on the bus,
+  the global brightness capped at the strip's (brightness, max_brightness).
+  LEDs a frame's packets do not cover keep their last streamed state.
+  Packets of other types (RGBW, 16 bit, HSL, ..) are counted as invalid.
+  """
+
+  __slots__ = ('strips', 'targets', 'socks', 'socket_path', 'packet', 'packet_view', 'packets', 'packets_invalid',
+    'frames', 'running', 'thread', 'debug')
+
+  def __init__(self, strips, port=0, bind='', socket_path='', debug=False):
+    """port: UDP port to listen on, 0: none, socket_path: Unix datagram socket to create, '': none"""
+    self.strips = strips
+    self.debug = debug
+    for strip in strips:
+      strip.openStream()
+    # destination id -> [(strip, index of its first LED in the destination)]
+    self.targets = {DDP_ID_ALL: [(strip, 0) for strip in strips]}
+    base = 0
+    self.targets[DDP_ID_DEFAULT] = []
+    for (i, strip) in enumerate(strips):
+      self.targets[DDP_ID_DEFAULT].append((strip, base))
+      self.targets[DDP_ID_DEFAULT + 1 + i] = [(strip, 0)]
+      base += strip.nleds
+    self.packet = bytearray(PACKET_MAX)
+    self.packet_view = memoryview(self.packet)
+    self.packets = 0
+    self.packets_invalid = 0
+    self.frames = 0
+    self.running = False
+    self.thread = None
+    self.socks = []
+    self.socket_path = socket_path
+    if port:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind((bind, port))
+      self.socks.append(sock)
+      print("stream: DDP on udp", (bind or '*') + ':' + str(port))
+    if socket_path:
+      if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        os.unlink(socket_path) # left over by an earlier run
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+      sock.bind(socket_path)
+      self.socks.append(sock)
+      print("stream: DDP on", socket_path)
+
+  def receive(self, sock):
+    """reads one packet from sock and writes its pixels into the strips"""
+    try:
+      size = sock.recv_into(self.packet)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError as e:
+      eprint('stream: receive failed:', e)
+      return
+    t0 = time.perf_counter()
+    self.packets += 1
+    if not self.handle(size):
+      self.packets_invalid += 1
+      self.debug and print("stream: invalid packet of", size, "bytes")
+    tracer.add('stream', None, t0, time.perf_counter())
+
+  def handle(self, size):
+    """one DDP packet in self.packet, False if it is invalid"""
+    if size < DDP_HEADER.size:
+      return False
+    (flags, seq, dtype, dest, offset, length) = DDP_HEADER.unpack_from(self.packet)
+    if flags & DDP_VERSION_MASK != DDP_VERSION_1:
+      return False
+    if flags & DDP_FLAG_QUERY: # status / config queries are not answered
+      return True
+    targets = self.targets.get(dest)
+    if targets is None:
+      return dest >= DDP_ID_RESERVED
+    start = DDP_HEADER.size + (DDP_TIMECODE_LEN if flags & DDP_FLAG_TIMECODE else 0)
+    if start + length > size:
+      return False
+    bpp = DDP_TYPE_BPP.get(dtype)
+    if bpp is None or offset % bpp:
+      return False
+    first = offset // bpp
+    count = length // bpp
+    if count:
+      data = np.frombuffer(self.packet_view[start:start + count * bpp], dtype=np.uint8).reshape(count, bpp)
+      for (strip, base) in targets:
+        lo = max(first, base)
+        hi = min(first + count, base + strip.nleds)
+        if lo >= hi:
+          continue
+        dst = strip.stream_in[lo - base:hi - base]
+        src = data[lo - first:hi - first]
+        if bpp == 4: # as on the bus, but no brighter than the strip's settings allow
+          dst[:] = src
+          strip.limitBrightness(dst)
+        else: # rgb -> brightness, blue, green, red
+          dst[:, 0] = strip.bn_lut[100]
+          dst[:, 1:] = src[:, ::-1]
+    if flags & DDP_FLAG_PUSH:
+      self.frames += 1
+      for (strip, base) in targets:
+        strip.postFrame()
+    return True
+
+  def run(self):
+    while self.running:
+      (readable, w, x) = select.select(self.socks, [], [], 1)
+      for sock in readable:
+        self.receive(sock)
+
+  def start(self):
+    """threads runtime: receives in its own thread"""
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name='stream', daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.running = False
+    if self.thread:
+      self.thread.join(2)
+      self.thread = None
+    for sock in self.socks:
+      sock.close()
+    self.socks = []
+    if self.socket_path and os.path.exists(self.socket_path):
+      os.unlink(self.socket_path)
+    print("stream: packets:", self.packets, "invalid:", self.packets_invalid, "frames:", self.frames)
@@ -0,0 +1,934 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# based on https://github.com/tinue/APA102_Pi
+
+"""One APA102 strip: frame output, frame buffer and the sensor value renderer"""
+
+import sys
+import time
+import threading
+from copy import copy
+
+import numpy as np
+from bisect import bisect_left, bisect_right
+
+from .scheduler import FrameScheduler
+from .color import LED_START, brightnessLut, GammaLut, Dither
+from .fade import Fade
+from .output import openOutput
+from .metrics import Histogram
+from .trace import tracer
+
+def eprint(*args, **kwargs):
+  print(*args, file=sys.stderr, **kwargs)
+  sys.stderr.flush()
+
+START_FRAME_LEN = 4
+
+def endFrameLen(nleds):
+  """the data needs nleds/2 extra clock edges to reach the last LED: nleds/16 bytes"""
+  return (nleds + 15) // 16
+
+def frameLen(nleds):
+  """bytes of a full frame: start frame, pixels, end frame"""
+  return START_FRAME_LEN + 4 * nleds + endFrameLen(nleds)
+
+ERROR_COLORS = [ "red", "green", "blue" ]
+SELFTEST_STEP_S = 0.33 # each color of the startup test is shown this long
+DITHER_MIN_FPS = 50 # dithered strips are refreshed at least this often, slower visibly flickers
+STREAM_FRAME = 'frame' # posted instead of a value: a streamed frame is waiting
+
+# settings a running strip takes over on reload, all others need a restart
+LIVE_KEYS = ('brightness', 'max_brightness', 'colors', 'thresholds', 'thresholds_single', 'ledcfg', 'maxvalue', 'timeout_s', 'interval', 'skip')
+# everything the renderers read that LIVE_KEYS change, swapped in as a whole
+RENDER_STATE = ('cfg', 'timeout_s', 'interval', 'skip', 'brightness', 'max_brightness', 'bn_lut', 'off_pixel', 'bar', 'segments')
+# the settings RENDER_STATE is compiled from, all others do not change it
+STATE_KEYS = ('leds', 'fixed', 'maxvalue', 'thresholds', 'thresholds_single', 'ledcfg', 'colors', 'segments',
+  'timeout_s', 'interval', 'skip', 'brightness', 'max_brightness')
+# the settings a Bar needs beside leds, of the strip or of each of its segments
+BAR_KEYS = ['thresholds', 'thresholds_single', 'maxvalue']
+
+def segmentTarget(target, segment):
+  """a segment's target: the strip's, with the segment's target settings and value on top"""
+  target = dict(target)
+  target.update(segment.get('target') or {})
+  if 'value' in segment:
+    target['value'] = segment['value']
+  return target
+
+def targetBinding(name, target, hostname):
+  """
+  (topic, tags, value key) of a target: $host/sensors/<tags.sensor>/<measurement>,
+  either may be an MQTT wildcard (+), or the whole topic (filter) as topic.
+  The other tags filter the messages, a tag with value + only has to be there.
+  """
+  if not 'value' in target:
+    raise ValueError(name + ': no value in target')
+  tags = dict(target.get('tags') or {})
+  if 'topic' in target:
+    return (target['topic'], tags, target['value'])
+  if not 'sensor' in tags:
+    raise ValueError(name + ': no sensor in cfg')
+  if not 'measurement' in target:
+    raise ValueError(name + ': no measurement or value in cfg')
+  sensor = tags.pop('sensor') # implied by topic, no need to check
+  return ('/'.join([hostname, 'sensors', sensor, target['measurement']]), tags, target['value'])
+
+class Bar(object):
+  """
+  The compiled config of one bar: the whole strip, or one of its segments
+  from LED first on. Palette, thresholds and one encoded image per bar
+  step, compiled once from cfg with the strip's pixel encoding; drawBar()
+  only reads these.
+  """
+
+  __slots__ = (
+    'name', 'cfg', 'debug', 'first', 'nleds', 'fixed', 'max_value', 'thresholds', 'thresholds_single',
+    'bn_lut', 'off_pixel', 'palette_rgb', 'palette', 'threshold_bounds', 'threshold_colors', 'strip_colors',
+    'bar_from', 'bar_frames', 'fixed_frames',
+  )
+
+  def __init__(self, name, cfg, bn_lut, off_pixel, first=0, debug=False):
+    """cfg: leds, fixed, maxvalue, thresholds, thresholds_single, ledcfg, colors"""
+    self.name = name
+    self.debug = debug
+    self.first = first
+    self.nleds = cfg['leds']
+    self.fixed = min(cfg['fixed'], self.nleds)
+    self.setConfig(cfg, bn_lut, off_pixel)
+    self.compilePalette()
+    self.compileThresholds()
+    self.preCalcStrip()
+    self.compileBarLevels()
+    self.compileFixedLevels()
+
+  def setConfig(self, cfg, bn_lut, off_pixel):
+    self.cfg = cfg
+    self.max_value = cfg['maxvalue']
+    self.thresholds = cfg['thresholds']
+    self.thresholds_single = cfg['thresholds_single']
+    self.bn_lut = bn_lut
+    self.off_pixel = off_pixel
+
+  def recompiled(self, cfg, changed, bn_lut, off_pixel):
+    """a copy for cfg, only the tables that depend on the changed keys are compiled again"""
+    new = copy(self)
+    new.setConfig(cfg, bn_lut, off_pixel)
+    # each step depends on the ones before it
+    palette = 'brightness' in changed or 'max_brightness' in changed or 'colors' in changed
+    palette and new.compilePalette()
+    thresholds = palette or 'thresholds' in changed
+    thresholds and new.compileThresholds()
+    single = thresholds or 'thresholds_single' in changed
+    single and new.preCalcStrip()
+    (single or 'ledcfg' in changed) and new.compileBarLevels()
+    thresholds and new.compileFixedLevels()
+    return new
+
+  def encodePixel(self, red, green, blue, bright_percent=100):
+    return bytes((self.bn_lut[bright_percent], blue, green, red))
+
+  def compilePalette(self):
+    """colors resolved once: name -> (r, g, b) and name -> encoded pixel"""
+    self.palette_rgb = {}
+    self.palette = {}
+    for (colorname, intcol) in self.cfg['colors'].items():
+      rgb = ((intcol & 0xFF0000) >> 16, (intcol & 0x00FF00) >> 8, intcol & 0x0000FF)
+      if self.debug:
+        rgb = tuple(1 if c > 0 else 0 for c in rgb)
+      self.palette_rgb[colorname] = rgb
+      self.palette[colorname] = self.encodePixel(*rgb)
+    self.debug and print(self.name, "palette", self.palette_rgb)
+
+  def str2hexColor(self, strcolor):
+    if not strcolor in self.palette_rgb:
+      eprint(strcolor, "not found in", self.cfg['colors'])
+      return False
+    return self.palette_rgb[strcolor]
+
+  def compileThresholds(self):
+    """thresholds as sorted boundary array for bisect, colors by index"""
+    self.threshold_bounds = []
+    self.threshold_colors = []
+    for (bound, color) in sorted(self.thresholds, key=lambda t: t[0]):
+      if not color in self.palette:
+        eprint('threshold color', color, 'not found in', self.cfg['colors'])
+      self.threshold_bounds.append(bound)
+      self.threshold_colors.append(color)
+
+  def getColorFromThreshold(self, value):
+    i = bisect_right(self.threshold_bounds, value) - 1 # last threshold <= value
+    color = self.threshold_colors[i] if i >= 0 else ''
+    self.debug and print("new color:", color)
+    return(color)
+
+  def preCalcStrip(self):
+    self.strip_colors = [] # [(0,0,0xFF,100)] # r,g,b, brightness
+    fixed = self.fixed
+    for led in range(fixed):
+      colors = (0,0,0xFF,100)
+      self.strip_colors.append(colors)
+      self.debug and print("#", led, "fixed", self.strip_colors[led])
+
+    for led in range(len(self.thresholds_single)):
+      this_led_min_val = self.thresholds_single[led]
+      colorstr = self.getColorFromThreshold(this_led_min_val)
+      (red, green, blue) = self.str2hexColor(colorstr)
+      self.strip_colors.append( (red, green, blue, 100) )
+      self.debug and print(fixed + led, self.strip_colors[fixed + led])
+
+  def compileBarLevels(self):
+    """
+    ledcfg compiled once: sorted 'from' boundaries and one encoded image of the
+    bar (LEDs fixed .. nleds-1) per step, so a value costs one bisect and one copy
+    """
+    fixed = self.fixed
+    barlen = self.nleds - fixed
+    bar_off = self.off_pixel * barlen
+    steps = []
+    if 'ledcfg' in self.cfg:
+      for step in self.cfg['ledcfg']:
+        leds = []
+        for led_i in step['leds']:
+          (red, green, blue) = self.str2hexColor(led_i['c'])
+          # todo calc bn by rgb/bn
+          leds.append((red, green, blue, 100))
+        steps.append((step['from'], leds))
+    else: # no ledcfg: one more LED of strip_colors per thresholds_single entry
+      for led in range(len(self.thresholds_single)):
+        steps.append((self.thresholds_single[led], self.strip_colors[fixed:fixed + led + 1]))
+    steps.sort(key=lambda step: step[0])
+
+    self.bar_from = []
+    self.bar_frames = []
+    for (step_from, leds) in steps:
+      frame = bytearray(bar_off)
+      for (i, (red, green, blue, bn)) in enumerate(leds[:barlen]):
+        frame[4 * i:4 * i + 4] = self.encodePixel(red, green, blue, bn)
+      self.bar_from.append(step_from)
+      self.bar_frames.append(bytes(frame))
+      self.debug and print("bar from", step_from, frame.hex())
+    print(self.name, "bar with", len(self.bar_frames), "steps compiled")
+
+  def compileFixedLevels(self):
+    """fixed LEDs show the threshold color of the value, one ready block per threshold"""
+    self.fixed_frames = [self.palette.get(color, self.off_pixel) * self.fixed for color in self.threshold_colors]
+
+class Strip(object):
+  """
+  A strip on its own SPI bus/CS line with its own target and render config.
+  Values are posted from the MQTT thread into a latest-value-wins slot and
+  rendered in the strip's own thread (run()) into the back buffer. show() hands the finished frame to
+  the writer thread, which always sends the newest one and drops frames
+  that were replaced before it got to them.
+  """
+
+  __slots__ = (
+    'name', 'cfg', 'debug', 'tags', 'valuekey', 'topic', 'segment_targets', 'segments',
+    'nleds', 'skip', 'timeout_s', 'interval', 'fps', 'fade_s', 'brightness', 'max_brightness',
+    'bn_lut', 'off_pixel', 'bar',
+    'back', 'ready', 'front', 'led_arr', 'pixels', 'end_frame', 'end_saved', 'fade', 'scene', 'output', 'dither',
+    'dirty_leds', 'ready_dirty', 'frame_lock', 'frames_sent', 'frames_skipped', 'frames_dropped', 'first_frame',
+    'out', 'out_write', 'writer', 'writing', 'thread',
+    'value_lock', 'pending_value', 'values_received', 'values_filtered', 'values_coalesced', 'values_rendered', 'on_post', 'on_config',
+    'pending_since', 'render_since', 'ready_since', 'spi_hist', 'latency_hist', 'timeouts', 'error_s',
+    'running', 'last_update', 'last_value', 'error_since', 'selftest_since', 'scheduler', 'pending_state',
+    'stream_in', 'stream_ready', 'stream_taken', 'stream_new',
+  )
+
+  def __init__(self, name, cfg, hostname, debug=False, state=None):
+    """state: render state of renderState() compiled earlier from the same cfg, e.g. cached"""
+    self.name = name
+    self.cfg = cfg
+    self.debug = debug
+
+    # with segments, each shows a value of its own on a part of the strip
+    segments = cfg.get('segments') or []
+    for param in ['target'] + ([] if segments else BAR_KEYS):
+      if not param in cfg:
+        raise ValueError(name + ': no ' + param + ' in cfg')
+    self.segment_targets = [targetBinding(name, segmentTarget(cfg['target'], segment), hostname) for segment in segments]
+    if segments:
+      (self.topic, self.tags, self.valuekey) = self.segment_targets[0]
+    else:
+      (self.topic, self.tags, self.valuekey) = targetBinding(name, cfg['target'], hostname)
+
+    self.nleds = cfg['leds']
+    self.skip = cfg['skip']
+    self.timeout_s = cfg['timeout_s']
+    self.interval = cfg['interval']
+    self.fps = cfg['fps']
+    self.fade_s = cfg['fade_s']
+    self.brightness = cfg['brightness']
+    self.max_brightness = cfg['max_brightness']
+    self.bn_lut = brightnessLut(self.brightness, self.max_brightness) # percent -> header byte
+    self.off_pixel = self.encodePixel(0,0,0,0)
+
+    # each frame is one preallocated buffer: start frame, pixels, end frame
+    # back: rendered into, ready: newest complete frame, front: on the bus
+    nleds = self.nleds
+    self.back = self.newFrame()
+    self.ready = self.newFrame()
+    self.front = self.newFrame()
+    self.led_arr = self.back[2] # Pixel buffer, view into the back frame
+    self.pixels = self.back[3] # the same as NumPy array, one row per LED
+    self.end_frame = bytes(endFrameLen(nleds))
+    self.end_saved = bytearray(endFrameLen(nleds)) # front frame bytes under a shortened end frame
+
+    # with fading, renderers write the target into the scene buffer and the
+    # frame ticks blend the back frame towards it
+    self.fade = None
+    if self.fade_s > 0:
+      self.fade = Fade(nleds, self.fade_s)
+      self.scene = memoryview(bytearray(self.back[2]))
+      self.led_arr = self.scene
+      self.pixels = np.frombuffer(self.scene, dtype=np.uint8).reshape(nleds, 4)
+
+    # output stage from the linear back frame into the frame for the bus:
+    # gamma correction, or temporal dithering (gamma included)
+    self.output = None
+    self.dither = None
+    if cfg['dither']:
+      self.output = self.dither = Dither(cfg['gamma'], nleds)
+      if self.fps < DITHER_MIN_FPS:
+        print(name, "dithering: fps", self.fps, "raised to", DITHER_MIN_FPS)
+        self.fps = DITHER_MIN_FPS
+      if frameLen(nleds) * 8.0 / cfg['busfreq'] > 1.0 / self.fps:
+        eprint(name, "dithering: a frame takes longer on the bus than 1/fps, busfreq", cfg['busfreq'], "is too low, it will flicker")
+    elif cfg['gamma'] != 1:
+      self.output = GammaLut(cfg['gamma'])
+
+    # LEDs 0 .. dirty_leds-1 may differ from what is on the strip, the rest is unchanged.
+    # Starts with all LEDs dirty, the power-up state of the strip is unknown.
+    self.dirty_leds = nleds
+    self.ready_dirty = 0 # dirty LEDs of the ready frame, including replaced ones
+    self.frame_lock = threading.Condition()
+    self.frames_sent = 0
+    self.frames_skipped = 0
+    self.frames_dropped = 0
+    self.first_frame = threading.Event() # set once a frame is out, e.g. to signal readiness
+
+    self.out = None # output backend, SPI bus or simulator
+    self.writer = None
+    self.writing = False
+    self.thread = None
+    # latest value wins: values posted while the previous frame is still
+    # waiting for the bus replace each other, only the newest gets rendered
+    self.value_lock = threading.Condition()
+    self.pending_value = None
+    self.values_received = 0
+    self.values_filtered = 0 # messages on the topic without our tags / value
+    self.values_coalesced = 0
+    self.values_rendered = 0
+    # metrics: arrival of the newest value, carried along with its frame to the bus
+    self.pending_since = None
+    self.render_since = None
+    self.ready_since = None
+    self.spi_hist = Histogram() # transfer durations
+    self.latency_hist = Histogram() # message arrival -> frame sent
+    self.timeouts = 0
+    self.error_s = 0.0 # time spent in finished timeouts
+    self.on_post = None # optional callback after post(), e.g. to wake an event loop
+    self.on_config = None # optional callback after applyConfig(), in the render thread / task
+    self.running = False
+    self.last_update = time.monotonic()
+    self.error_since = None # start of the current timeout, error wheel running
+    self.selftest_since = None # start of the startup color test
+    self.last_value = None # shown value, rendered again after a config reload
+    self.pending_state = None # reloaded render state, swapped in on the next frame
+    self.scheduler = None
+    # streamed frames: received into stream_in, posted as stream_ready,
+    # rendered from stream_taken; allocated by openStream()
+    self.stream_in = None
+    self.stream_ready = None
+    self.stream_taken = None
+    self.stream_new = False
+
+    if state:
+      for (attr, value) in state.items():
+        setattr(self, attr, value)
+      print(self.name, "strip with", self.nleds , "LEDs, ", len(self.segments) or min(cfg['fixed'], self.nleds),
+            "segments," if self.segments else "fixed,", "compiled config from cache")
+      return
+    print(self.name, "strip with", self.nleds , "LEDs, ", len(segments) or min(cfg['fixed'], self.nleds),
+          "segments." if segments else "fixed.")
+    # the whole strip is one bar, unless it has segments
+    self.bar = None if segments else Bar(name, cfg, self.bn_lut, self.off_pixel, debug=debug)
+    self.segments = self.compileSegments(cfg, self.bn_lut, self.off_pixel)
+
+  def __repr__(self):
+    if self.cfg.get('output', 'spi') == 'sim':
+      return "Strip(%s, simulated, %d LEDs, %s)" % (self.name, self.nleds, self.topic)
+    return "Strip(%s, spidev%d.%d, %d LEDs, %s)" % (self.name, self.cfg['bus'], self.cfg['address'], self.nleds, self.topic)
+
+  def newFrame(self):
+    """(buffer, view, pixel view, pixels as (nleds, 4) NumPy array) of a blank frame"""
+    frame = bytearray(START_FRAME_LEN) + bytearray([LED_START,0,0,0] * self.nleds) + bytearray(endFrameLen(self.nleds))
+    view = memoryview(frame)
+    pixel_view = view[START_FRAME_LEN:START_FRAME_LEN + 4 * self.nleds]
+    return (frame, view, pixel_view, np.frombuffer(pixel_view, dtype=np.uint8).reshape(self.nleds, 4))
+
+  def open(self, writer=True, out=None):
+    """
+    opens the output, by default the one in cfg (SPI bus or simulator), or
+    out: any object with write(buffer) and close(). With writer=False frames
+    are only sent by writeReady() calls
+    """
+    self.out = out or openOutput(self.cfg)
+    self.out_write = self.out.write
+    self.debug and print(self.name, 'output', self.out, 'frame', frameLen(self.nleds), 'bytes')
+    if writer:
+      self.writing = True
+      self.writer = threading.Thread(target=self.writeFrames, name=self.name + '-spi')
+      self.writer.start()
+
+  def writeShortened(self, view, dirty_leds):
+    """
+    sends LEDs 0 .. dirty_leds-1 as one transfer: their end frame is put
+    right behind them in the front frame and the bytes it covers restored
+    afterwards, so no stall between pixels and end frame and no copy. Only
+    the writer touches front, present() copies from ready under frame_lock
+    """
+    end = START_FRAME_LEN + 4 * dirty_leds
+    end_len = endFrameLen(dirty_leds)
+    saved = memoryview(self.end_saved)[:end_len]
+    saved[:] = view[end:end + end_len]
+    view[end:end + end_len] = self.end_frame[:end_len]
+    try:
+      self.out_write(view[:end + end_len])
+    finally:
+      view[end:end + end_len] = saved
+
+  def close(self):
+    """stops the writer after it sent the last frame and closes the bus"""
+    if self.writer:
+      with self.frame_lock:
+        self.writing = False
+        self.frame_lock.notify_all()
+      self.writer.join()
+      self.writer = None
+    elif self.out:
+      self.writeReady()
+    if self.out:
+      self.out.close()
+      self.out = None
+
+  # --- frame buffer ---
+
+  def encodePixel(self, red, green, blue, bright_percent=100):
+    """bright_percent: int 0..100 of the strip brightness"""
+    return bytes((self.bn_lut[bright_percent], blue, green, red))
+
+  def setPixel(self, lednr, red, green, blue, bright_percent=100):
+    if lednr < 0 or lednr >= self.nleds:
+      return
+    start_index = 4 * lednr
+    pixel = self.encodePixel(red, green, blue, bright_percent)
+    led_arr = self.led_arr
+    if led_arr[start_index:start_index + 4] == pixel:
+      return
+    led_arr[start_index:start_index + 4] = pixel
+    if lednr >= self.dirty_leds:
+      self.dirty_leds = lednr + 1
+    self.debug and print(lednr, ":", pixel.hex())
+
+  def markDirty(self, leds):
+    if leds > self.dirty_leds:
+      self.dirty_leds = leds
+
+  def setPixels(self, first_led, pixels):
+    """
+    write already encoded pixels (4 bytes each) starting at first_led,
+    from any contiguous byte buffer, e.g. bytes or a (n, 4) uint8 array
+    """
+    pixels = memoryview(pixels).cast('B')
+    start_index = 4 * first_led
+    current = self.led_arr[start_index:start_index + len(pixels)]
+    if current == pixels:
+      return
+    # bisect for the last LED that differs, each step is one memcmp of a suffix
+    lo = 0 # suffix from LED lo differs
+    hi = len(pixels) // 4 # suffix from LED hi is equal
+    while hi - lo > 1:
+      mid = (lo + hi) // 2
+      if current[4 * mid:] == pixels[4 * mid:]:
+        hi = mid
+      else:
+        lo = mid
+    self.led_arr[start_index:start_index + len(pixels)] = pixels
+    self.markDirty(first_led + hi)
+
+  def fill(self, start, stop, pixel):
+    """sets LEDs start .. stop-1 to one encoded pixel, one vectorized compare and assign"""
+    start = max(start, 0)
+    stop = min(stop, self.nleds)
+    if start >= stop:
+      return
+    region = self.pixels[start:stop]
+    pixel = np.frombuffer(pixel, dtype=np.uint8)
+    changed = np.flatnonzero((region != pixel).any(axis=1))
+    if len(changed) == 0:
+      return
+    region[:] = pixel
+    self.markDirty(start + int(changed[-1]) + 1)
+
+  def blankTail(self, first_led):
+    """switches off all LEDs from first_led on"""
+    self.fill(first_led, self.nleds, self.off_pixel)
+
+  def show(self, immediate=False):
+    """hands the rendered frame to the writer thread (or starts fading to it), never blocks on the bus"""
+    dirty_leds = self.dirty_leds
+    if dirty_leds == 0: # nothing changed since the last frame, keep the bus free
+      self.frames_skipped += 1
+      self.render_since = None # the value did not change anything to measure
+      return
+    t0 = time.perf_counter()
+    self.dirty_leds = 0
+    if self.fade:
+      if not immediate:
+        self.fade.begin(self.back[2], self.scene, time.monotonic())
+        tracer.add('show', self.name, t0, time.perf_counter())
+        return
+      self.fade.active = False
+      self.back[2][:] = self.scene
+      dirty_leds = self.nleds
+    self.present(dirty_leds)
+    tracer.add('show', self.name, t0, time.perf_counter())
+
+  def present(self, dirty_leds):
+    with self.frame_lock:
+      if self.render_since is not None and self.ready_since is None:
+        self.ready_since = self.render_since
+      self.render_since = None
+      if self.ready_dirty:
+        self.frames_dropped += 1 # writer did not get to the previous one, it is replaced
+      if self.output: # back stays the linear, current frame
+        self.output.apply(self.back[2], self.ready[2])
+        if self.dither: # dithering changes every pixel with a fraction
+          dirty_leds = self.nleds
+        self.ready_dirty = max(self.ready_dirty, dirty_leds)
+        self.frame_lock.notify_all()
+        return
+      (self.back, self.ready) = (self.ready, self.back)
+      # bring the new back frame up to date, the following renders only change parts of it;
+      # under the lock: once the writer took ready, writeShortened puts the end frame into it
+      self.back[2][:] = self.ready[2]
+      self.ready_dirty = max(self.ready_dirty, dirty_leds)
+      self.frame_lock.notify_all()
+    if not self.fade:
+      self.led_arr = self.back[2]
+      self.pixels = self.back[3]
+
+  def stepFade(self, now):
+    if self.fade and self.fade.active:
+      self.fade.step(now, self.back[2])
+      self.present(self.fade.dirty_leds)
+
+  def writeReady(self):
+    """sends the newest complete frame, returns False if there was none"""
+    tracer.profilePoint() # writer thread / executor
+    with self.frame_lock:
+      if not self.ready_dirty:
+        return False
+      (self.front, self.ready) = (self.ready, self.front)
+      dirty_leds = self.ready_dirty
+      self.ready_dirty = 0
+      since = self.ready_since
+      self.ready_since = None
+      self.frame_lock.notify_all() # ready slot free for the next frame
+    view = self.front[1]
+    try:
+      t0 = time.perf_counter()
+      if dirty_leds == self.nleds:
+        self.out_write(view) # start frame, pixels and end frame in one transfer
+      else: # LEDs behind the last changed one keep their state, stop clocking there
+        self.writeShortened(view, dirty_leds)
+      t1 = time.perf_counter()
+      self.spi_hist.add((t1 - t0) * 1000)
+      tracer.add('spi', self.name, t0, t1)
+      if since is not None:
+        self.latency_hist.add((time.monotonic() - since) * 1000)
+      self.frames_sent += 1
+      self.first_frame.set()
+    except Exception as e:
+      eprint(self.name, 'output write failed:', e)
+    return True
+
+  def writeFrames(self):
+    """writer thread: pushes the newest complete frame to the bus"""
+    while True:
+      with self.frame_lock:
+        while not self.ready_dirty and self.writing:
+          self.frame_lock.wait()
+        if not self.ready_dirty: # stopped and nothing left to send
+          break
+      self.writeReady()
+    self.debug and print(self.name, "writer thread finished")
+
+  def clearStrip(self):
+    self.fill(0, self.nleds, self.off_pixel)
+    self.show(immediate=True)
+
+  # --- compiled render config ---
+
+  def setAllColor(self, color, immediate=False):
+    palette = (self.bar or self.segments[0]).palette
+    if not color in palette:
+      eprint(color, "not found in", self.cfg['colors'])
+      return
+    pixel = palette[color]
+    # led 0 and all after skip get the color
+    self.fill(0, 1, pixel)
+    self.fill(1, 1 + self.skip, self.off_pixel)
+    self.fill(1 + self.skip, self.nleds, pixel)
+    self.show(immediate)
+
+  def compileSegments(self, cfg, bn_lut, off_pixel):
+    """
+    segments: one Bar per entry, from the strip's settings with the entry's
+    on top (leds, first, fixed, maxvalue, thresholds, thresholds_single,
+    ledcfg, colors). They follow each other from LED 0, first moves one
+    further back.
+    """
+    segments = []
+    end = 0
+    for (i, scfg) in enumerate(cfg.get('segments') or []):
+      bcfg = dict(cfg)
+      bcfg.pop('segments')
+      bcfg.update(scfg)
+      name = self.name + '.' + str(scfg.get('name', i))
+      if not 'leds' in scfg:
+        raise ValueError(self.name + ': no leds in segment ' + str(i))
+      for param in BAR_KEYS:
+        if not param in bcfg:
+          raise ValueError(name + ': no ' + param + ' in the segment or its strip')
+      first = bcfg.get('first', end)
+      if first < end or first + bcfg['leds'] > self.nleds:
+        raise ValueError(name + ': LEDs %d..%d overlap the one before or are not on the strip' % (first, first + bcfg['leds'] - 1))
+      end = first + bcfg['leds']
+      segments.append(Bar(name, bcfg, bn_lut, off_pixel, first=first, debug=self.debug))
+    return segments
+
+  def drawBar(self, bar, value, brightness=100):
+    """value as bar with the compiled config bar, the strip's own or a segment's"""
+    if value > bar.max_value:
+      value = bar.max_value
+
+    first = bar.first
+    fixed = bar.fixed
+    if fixed:
+      t = bisect_right(bar.threshold_bounds, value) - 1 # last threshold <= value
+      if t < 0:
+        self.fill(first, first + fixed, self.off_pixel)
+      elif brightness == 100:
+        self.setPixels(first, bar.fixed_frames[t])
+      else:
+        (fixr, fixg, fixb) = bar.palette_rgb[bar.threshold_colors[t]]
+        self.fill(first, first + fixed, self.encodePixel(fixr, fixg, fixb, brightness))
+      self.debug and print(bar.name, "fixed", bar.threshold_colors[t] if t >= 0 else '', brightness)
+
+    step = bisect_left(bar.bar_from, value) - 1 # last step with from < value
+    if step >= 0:
+      self.setPixels(first + fixed, bar.bar_frames[step])
+    else:
+      self.fill(first + fixed, first + bar.nleds, self.off_pixel)
+    self.debug and print(bar.name, "bar step", step, "for", value)
+
+  def setBarLevel(self, value, brightness = 100):
+    t0 = time.perf_counter()
+    self.last_value = value
+    self.drawBar(self.bar, value, brightness)
+    self.debug and print("--------------------")
+    self.show()
+    tracer.add('render', self.name, t0, time.perf_counter())
+
+  def setSegmentLevels(self, values):
+    """
+    values: one per segment, None keeps the segment's last one. All segments
+    are composed into the frame, which goes out as one transfer
+    """
+    t0 = time.perf_counter()
+    last = self.last_value if isinstance(self.last_value, tuple) else (None,) * len(self.segments)
+    values = tuple(last[i] if value is None else value for (i, value) in enumerate(values))
+    self.last_value = values
+    pos = 0
+    for (segment, value) in zip(self.segments, values):
+      self.fill(pos, segment.first, self.off_pixel) # LEDs between segments
+      if value is None: # nothing received yet
+        self.fill(segment.first, segment.first + segment.nleds, self.off_pixel)
+      else:
+        self.drawBar(segment, value)
+      pos = segment.first + segment.nleds
+    self.fill(pos, self.nleds, self.off_pixel)
+    self.debug and print("--------------------")
+    self.show()
+    tracer.add('render', self.name, t0, time.perf_counter())
+
+  # --- config reload ---
+
+  def compileConfig(self, cfg, ignore=()):
+    """
+    render state (RENDER_STATE: value) for a changed config, None if no live
+    setting changed. Only what depends on the changed settings is compiled
+    again, into new Bars: the strip itself keeps rendering untouched.
+    ignore: keys applied by someone else, no restart needed. Raises on an
+    invalid config.
+    """
+    changed = set(key for key in LIVE_KEYS if cfg.get(key) != self.cfg.get(key))
+    restart = [key for key in cfg if not key in LIVE_KEYS and not key in ignore and key != 'strips' and cfg[key] != self.cfg.get(key)]
+    restart and eprint(self.name, 'changes of', restart, 'need a restart, ignored')
+    if not changed:
+      return None
+    print(self.name, 'reloading', sorted(changed))
+
+    new_cfg = dict(self.cfg)
+    for key in changed:
+      if key in cfg:
+        new_cfg[key] = cfg[key]
+      else:
+        new_cfg.pop(key)
+    state = self.renderState()
+    state['cfg'] = new_cfg
+    state['timeout_s'] = new_cfg['timeout_s']
+    state['interval'] = new_cfg['interval']
+    state['skip'] = new_cfg['skip']
+    if 'brightness' in changed or 'max_brightness' in changed:
+      state['brightness'] = new_cfg['brightness']
+      state['max_brightness'] = new_cfg['max_brightness']
+      state['bn_lut'] = brightnessLut(state['brightness'], state['max_brightness'])
+      state['off_pixel'] = bytes((state['bn_lut'][0], 0, 0, 0))
+    if self.bar:
+      state['bar'] = self.bar.recompiled(new_cfg, changed, state['bn_lut'], state['off_pixel'])
+    if self.segments: # they take the strip's settings as defaults
+      state['segments'] = self.compileSegments(new_cfg, state['bn_lut'], state['off_pixel'])
+    return state
+
+  def renderState(self):
+    return dict((attr, getattr(self, attr)) for attr in RENDER_STATE)
+
+  def postConfig(self, state):
+    """hands a compiled render state to the render thread, a newer one replaces it"""
+    with self.value_lock:
+      self.pending_state = state
+
+  def applyConfig(self):
+    """swaps in a posted render state between two frames, True if there was one"""
+    with self.value_lock:
+      state = self.pending_state
+      self.pending_state = None
+    if state is None:
+      return False
+    for (attr, value) in state.items():
+      setattr(self, attr, value)
+    print(self.name, 'config reloaded')
+    self.on_config and self.on_config(self)
+    return True
+
+  # --- input & main loop ---
+
+  def bindings(self):
+    """
+    [(topic or filter, tags, value key)] of the values this strip shows, for
+    the Dispatcher. With segments, the value key is a tuple of one key per
+    segment (None: not on this topic), so one message fills all its segments.
+    """
+    if not self.segment_targets:
+      return [(self.topic, self.tags, self.valuekey)]
+    groups = {} # (topic, tags) -> (topic, tags, [value key per segment])
+    for (i, (topic, tags, valuekey)) in enumerate(self.segment_targets):
+      group = groups.setdefault((topic, repr(sorted(tags.items()))), (topic, tags, [None] * len(self.segment_targets)))
+      group[2][i] = valuekey
+    return [(topic, tags, tuple(valuekeys)) for (topic, tags, valuekeys) in groups.values()]
+
+  def post(self, value):
+    """called from the MQTT thread, the value is rendered in the strip thread"""
+    with self.value_lock:
+      self.values_received += 1
+      if self.pending_value is not None:
+        self.values_coalesced += 1 # replaced before it was rendered
+      if isinstance(value, tuple) and isinstance(self.pending_value, tuple): # segment values of another message
+        value = tuple(p if v is None else v for (v, p) in zip(value, self.pending_value))
+      self.pending_value = value
+      self.last_update = self.pending_since = time.monotonic()
+      self.selftest_since = None # values win over the startup test
+      self.value_lock.notify()
+    self.on_post and self.on_post(self)
+
+  def openStream(self):
+    """allocates the buffers for streamed frames, returns the one to receive into: (nleds, 4) encoded pixels"""
+    if self.stream_in is None:
+      (self.stream_in, self.stream_ready, self.stream_taken) = [self.newFrame()[3] for i in range(3)]
+    return self.stream_in
+
+  def limitBrightness(self, pixels):
+    """caps the header bytes of encoded pixels ((n, 4) NumPy array) at the strip's brightness of 100 %"""
+    np.minimum(pixels[:, 0] | LED_START, self.bn_lut[100], out=pixels[:, 0])
+
+  def postFrame(self, pixels=None):
+    """
+    called from the stream input once stream_in holds a complete frame: it
+    becomes the ready one, a ready frame not rendered yet is replaced. The
+    new stream_in starts as a copy of it, so packets updating only part of
+    the strip keep the other LEDs. pixels: a complete frame elsewhere
+    (nleds * 4 bytes), copied to ready instead, stream_in stays untouched
+    """
+    with self.value_lock:
+      if pixels is None:
+        (self.stream_in, self.stream_ready) = (self.stream_ready, self.stream_in)
+        self.stream_in[:] = self.stream_ready
+      else:
+        self.stream_ready[:] = pixels
+        self.limitBrightness(self.stream_ready) # from other processes, no brighter than the strip's settings
+      self.stream_new = True
+      self.values_received += 1
+      if self.pending_value is not None:
+        self.values_coalesced += 1
+      self.pending_value = STREAM_FRAME
+      self.last_update = self.pending_since = time.monotonic()
+      self.selftest_since = None
+      self.value_lock.notify()
+    self.on_post and self.on_post(self)
+    return self.stream_in
+
+  def showFrame(self):
+    """renders the newest streamed frame"""
+    t0 = time.perf_counter()
+    with self.value_lock:
+      if self.stream_new:
+        (self.stream_ready, self.stream_taken) = (self.stream_taken, self.stream_ready)
+        self.stream_new = False
+    self.last_value = None # nothing to render again after a config reload
+    self.setPixels(0, self.stream_taken)
+    self.show()
+    tracer.add('render', self.name, t0, time.perf_counter())
+
+  def render(self, value):
+    """renders what takeValue() returned: a sensor value as bar, or a streamed frame"""
+    if value is STREAM_FRAME:
+      self.showFrame()
+    elif isinstance(value, tuple):
+      self.setSegmentLevels(value)
+    else:
+      self.setBarLevel(value)
+
+  def takeValue(self, timeout):
+    """newest posted value or None if none arrived within timeout"""
+    with self.value_lock:
+      if self.pending_value is None and self.running:
+        self.value_lock.wait(timeout)
+      value = self.pending_value
+      self.pending_value = None
+      if value is not None:
+        self.render_since = self.pending_since
+    return value
+
+  def waitForWriter(self, timeout):
+    """True once the writer took the last frame, until then new values keep coalescing"""
+    with self.frame_lock:
+      if self.ready_dirty and self.writing:
+        self.frame_lock.wait(timeout)
+      return not self.ready_dirty
+
+  def start(self):
+    self.running = True
+    self.thread = threading.Thread(target=self.run, name=self.name)
+    self.thread.start()
+
+  def stop(self):
+    with self.value_lock:
+      self.running = False
+      self.value_lock.notify() # wake up run()
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+
+  def isAlive(self):
+    return (self.thread is None or self.thread.is_alive()) and (self.writer is None or self.writer.is_alive())
+
+  def selfTest(self, now):
+    """
+    shows red, green and blue for SELFTEST_STEP_S each, rendered on the frame
+    schedule like the error wheel, so nothing waits for it. A value ends it.
+    """
+    self.selftest_since = now
+    self.setAllColor(ERROR_COLORS[0], immediate=True)
+
+  def renderFrame(self, now):
+    """frame tick: config reloads, the startup test, the error color wheel and fades are rendered on the frame schedule"""
+    if self.pending_state is not None and self.applyConfig():
+      if self.last_value is not None and self.error_since is None and self.selftest_since is None:
+        self.render(self.last_value)
+    since = self.selftest_since # cleared by post() in another thread
+    if since is not None:
+      step = int((now - since) / SELFTEST_STEP_S)
+      if step < len(ERROR_COLORS):
+        self.setAllColor(ERROR_COLORS[step], immediate=True)
+        return
+      self.selftest_since = None
+      self.fill(0, self.nleds, self.off_pixel)
+      self.show(immediate=True)
+    elif self.error_since is not None:
+      step = int((now - self.error_since) / self.interval) # next color every interval
+      self.setAllColor(ERROR_COLORS[step % len(ERROR_COLORS)])
+    self.stepFade(now)
+    if self.dither and self.dither.residual and not self.ready_dirty:
+      self.present(self.nleds) # next dithered frame of the same content
+
+  def setTimeout(self, now):
+    if self.error_since is None:
+      print(self.name, "timeout, running error color wheel")
+      self.error_since = now
+      self.timeouts += 1
+
+  def clearTimeout(self):
+    if self.error_since is not None:
+      print(self.name, "timeout over")
+      self.error_s += time.monotonic() - self.error_since
+      self.error_since = None
+
+  def run(self):
+    """strip thread: renders posted values, error color wheel on the frame schedule"""
+    self.scheduler = scheduler = FrameScheduler(self.fps)
+    while self.running:
+      tracer.profilePoint()
+      if self.waitForWriter(max(scheduler.remaining(), 0)):
+        value = self.takeValue(max(scheduler.remaining(), 0))
+        if value is not None:
+          self.clearTimeout()
+          try:
+            self.render(value)
+            self.values_rendered += 1
+          except Exception as e:
+            eprint(self.name, e)
+          continue
+      if scheduler.remaining() > 0:
+        continue
+
+      now = time.monotonic()
+      tracer.add('wake', self.name, scheduler.next_frame, now)
+      if self.last_update + self.timeout_s < now:
+        self.setTimeout(now)
+      else:
+        self.clearTimeout()
+      self.renderFrame(now)
+      tracer.add('tick', self.name, scheduler.next_frame, time.monotonic())
+      if not scheduler.tick():
+        self.debug and print(self.name, "frame overrun,", scheduler.stats())
+    print(self.name, "strip thread finished,", scheduler.stats())
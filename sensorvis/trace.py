@@ -0,0 +1,159 @@
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Hot path tracing into a ring buffer, dumped with percentiles on demand, and timed cProfile runs"""
+
+import time
+import threading
+from itertools import count
+
+import numpy as np
+
+PROFILE_GRACE_S = 5 # wait as long for threads to stop their profiler after the profile time
+
+class Tracer(object):
+  """
+  Records (stage, strip, start, end) of the hot path stages into preallocated
+  lists used as ring buffer: one counter step and four stores per record,
+  no lock (the counter is atomic under the GIL), no allocation. The oldest
+  records are overwritten. size 0 turns recording off.
+
+  Stages: decode (JSON), dispatch (tag filter & post), stream (a frame
+  packet into the strips), render (setBarLevel or a streamed frame,
+  incl. show), show, spi (transfer), wake (frame deadline -> thread awake:
+  scheduling and GIL), tick (frame deadline -> frame rendered), main (a
+  round of the main loop).
+  """
+
+  __slots__ = ('size', 'stages', 'names', 'starts', 'ends', 'counter', 'profile_until', 'profiles', 'lock')
+
+  def __init__(self, size=4096):
+    self.resize(size)
+    self.profile_until = None
+    self.profiles = {} # thread name -> [cProfile.Profile, running]
+    self.lock = threading.Lock()
+
+  def resize(self, size):
+    self.size = size
+    self.stages = [None] * size
+    self.names = [None] * size
+    self.starts = [0.0] * size
+    self.ends = [0.0] * size
+    self.counter = count()
+
+  def add(self, stage, name, start, end):
+    """start, end: from one clock, time.perf_counter() or the scheduler's time.monotonic() (the same on Linux)"""
+    if not self.size:
+      return
+    i = next(self.counter) % self.size
+    try:
+      self.stages[i] = stage
+      self.names[i] = name
+      self.starts[i] = start
+      self.ends[i] = end
+    except IndexError: # resized (smaller) meanwhile, record lost
+      pass
+
+  def records(self):
+    """[(stage, name, start, end)] in the buffer, oldest first"""
+    recs = [r for r in zip(self.stages, self.names, self.starts, self.ends) if r[0] is not None]
+    recs.sort(key=lambda r: r[2])
+    return recs
+
+  def summary(self, recs):
+    """one line per stage and strip: count and percentiles of the duration in ms"""
+    durations = {}
+    for (stage, name, start, end) in recs:
+      durations.setdefault((stage, name or ''), []).append(end - start)
+    lines = ["%-9s %-16s %7s %9s %9s %9s %9s" % ("stage", "strip", "n", "p50 ms", "p90 ms", "p99 ms", "max ms")]
+    for key in sorted(durations):
+      d = np.array(durations[key]) * 1000
+      (p50, p90, p99) = np.percentile(d, [50, 90, 99])
+      lines.append("%-9s %-16s %7d %9.3f %9.3f %9.3f %9.3f" % (key[0], key[1], len(d), p50, p90, p99, d.max()))
+    return lines
+
+  def dump(self, path):
+    """writes all records to path, returns the summary lines"""
+    recs = self.records()
+    lines = self.summary(recs)
+    with open(path, 'w') as f:
+      f.write("\n".join(lines) + "\n\n")
+      f.write("%12s %-9s %-16s %9s\n" % ("start s", "stage", "strip", "ms"))
+      for (stage, name, start, end) in recs:
+        f.write("%12.6f %-9s %-16s %9.3f\n" % (start, stage, name or '', (end - start) * 1000))
+    return lines
+
+  # --- cProfile of all threads that call profilePoint() ---
+
+  def startProfile(self, seconds):
+    self.profile_until = time.monotonic() + seconds
+
+  def profilePoint(self):
+    """
+    called in the loops of the threads: a profiler only sees the thread
+    that enabled it, so each thread starts and stops its own. From Python
+    3.12 on one profiler sees all threads and no second one can start.
+    """
+    until = self.profile_until
+    if until is None and not self.profiles:
+      return
+    name = threading.current_thread().name
+    with self.lock:
+      entry = self.profiles.get(name)
+      if until is None: # finished without this thread: its profiler is dropped
+        if entry is not None:
+          entry[0].disable()
+          del self.profiles[name]
+      elif time.monotonic() < until:
+        if entry is None:
+          import cProfile
+          profile = cProfile.Profile()
+          try:
+            profile.enable()
+          except ValueError: # 3.12+: another thread's profiler already sees this one
+            return
+          self.profiles[name] = [profile, True]
+      elif entry is not None and entry[1]:
+        entry[0].disable()
+        entry[1] = False
+
+  def finishProfile(self, path):
+    """
+    once the profile time is over and all threads stopped their profiler (or
+    PROFILE_GRACE_S later): combined stats written to path and returned,
+    else None
+    """
+    until = self.profile_until
+    now = time.monotonic()
+    if until is None or now < until:
+      return None
+    import pstats
+    with self.lock:
+      running = [name for (name, entry) in self.profiles.items() if entry[1]]
+      if running and now < until + PROFILE_GRACE_S:
+        return None
+      profiles = [self.profiles.pop(name)[0] for name in list(self.profiles) if not name in running]
+      self.profile_until = None # threads still running drop theirs on their next profilePoint()
+    stats = None
+    for profile in profiles:
+      stats = pstats.Stats(profile) if stats is None else stats.add(profile)
+    if stats is not None:
+      stats.dump_stats(path)
+    return stats
+
+tracer = Tracer() # one for the process, all threads record into it
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# coding=utf-8
+#
+# Copyright © 2018 UnravelTEC
+# Michael Maier <michael.maier+github@unraveltec.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Measures the time of full frame transfers on a real SPI bus for several
+LED counts and bus frequencies, next to the time the bits alone need.
+The result is the highest frame rate a strip of that length can run at.
+Only the clock matters, no strip needs to be connected.
+"""
+
+import time
+from copy import deepcopy
+from argparse import ArgumentParser
+
+from sensorvis import Strip, DEFAULTS
+from sensorvis.strip import frameLen
+from sensorvis.output import spidevBufsiz
+
+def benchCfg(bus, address, busfreq, leds):
+  """the daemon's defaults with the bench settings on top"""
+  cfg = deepcopy(DEFAULTS)
+  cfg.update({
+    "output": "spi", "bus": bus, "address": address, "busfreq": busfreq, "leds": leds,
+    "fixed": 0, "maxvalue": 1, "brightness": 0,
+    "thresholds": [[0, "off"]], "thresholds_single": [], "colors": {"off": 0},
+    "target": {"tags": {"sensor": "bench"}, "measurement": "bench", "value": "bench"},
+  })
+  return cfg
+
+def benchStrip(bus, address, busfreq, leds, frames):
+  """seconds per full frame: (mean, max) over frames transfers"""
+  strip = Strip('bench', benchCfg(bus, address, busfreq, leds), 'localhost')
+  strip.open(writer=False)
+  times = []
+  try:
+    for i in range(frames):
+      strip.present(leds) # every LED dirty: full frame
+      t0 = time.perf_counter()
+      strip.writeReady()
+      times.append(time.perf_counter() - t0)
+  finally:
+    strip.close()
+  return (sum(times) / len(times), max(times))
+
+parser = ArgumentParser(description='SPI transfer time of full APA102 frames')
+parser.add_argument("-b", "--bus", type=int, default=0, help="spi bus # {0}", metavar="n")
+parser.add_argument("-a", "--address", type=int, default=0, help="spi cs line {0}", metavar="i")
+parser.add_argument("-s", "--busfreq", type=int, nargs='+', default=[400000, 1000000, 4000000, 8000000],
+                            help="bus frequencies in Hz", metavar="f")
+parser.add_argument("-l", "--leds", type=int, nargs='+', default=[8, 144, 1000, 3000, 5000],
+                            help="LED counts", metavar="n")
+parser.add_argument("-n", "--frames", type=int, default=50, help="transfers per measurement {50}", metavar="n")
+args = parser.parse_args()
+
+rows = []
+for busfreq in args.busfreq:
+  for leds in args.leds:
+    nbytes = frameLen(leds)
+    (mean, worst) = benchStrip(args.bus, args.address, busfreq, leds, args.frames)
+    rows.append((leds, busfreq, nbytes, nbytes * 8000.0 / busfreq, mean * 1000, worst * 1000, 1 / mean))
+
+print("spidev bufsiz", spidevBufsiz(), "bytes")
+print("%6s %9s %7s %10s %10s %10s %8s" % ("leds", "busfreq", "bytes", "bits ms", "mean ms", "max ms", "max fps"))
+for row in rows:
+  print("%6d %9d %7d %10.2f %10.2f %10.2f %8.1f" % row)